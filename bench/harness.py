@@ -0,0 +1,565 @@
+"""offline throughput benchmark of the event handlers with synthetic gateway events"""
+
+import argparse
+import asyncio
+import datetime
+import io
+import itertools
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import types
+import zlib
+from time import monotonic
+from typing import Any, Optional
+
+ROOT: str = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if "ELECTROGRAM_BENCH_DIR" not in os.environ:
+    os.environ["ELECTROGRAM_BENCH_DIR"] = tempfile.mkdtemp(prefix="electrogram-bench-")
+WORKDIR: str = os.environ["ELECTROGRAM_BENCH_DIR"]
+
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+os.environ.setdefault("CHANNEL_ID", "1000")
+os.environ.setdefault("GUILD_ID", "2000")
+for name, folder in [
+    ("ATTACHMENTS_FOLDER", "attachments"),
+    ("AVATARS_FOLDER", "avatars"),
+    ("CUSTOM_EMOJIS_FOLDER", "emojis"),
+    ("OUTPUT_LEVEL_FOLDER", "levels"),
+]:
+    os.makedirs(os.path.join(WORKDIR, folder), exist_ok=True)
+    os.environ[name] = os.path.join(WORKDIR, folder)
+os.environ["JOURNAL_FILE"] = os.path.join(WORKDIR, "journal.sqlite3")
+if "--mysql" not in sys.argv:
+    os.environ["DB_BACKEND"] = "sqlite"
+    os.environ["DB_FILE"] = os.path.join(WORKDIR, "electrogram.sqlite3")
+
+import aiohttp.web  # noqa: E402
+import discord  # noqa: E402
+from PIL import Image  # noqa: E402
+
+import main  # noqa: E402
+
+MIXES: dict[str, str] = {
+    "default": "posts=200,edits=50,reactions=1000,deletes=20,streaks=1",
+    "posts": "posts=500",
+    "reaction-storm": "posts=20,reactions=5000",
+    "edits": "posts=100,edits=400",
+    "resume": "posts=100,reactions=300,replays=200",
+    "purge": "posts=200,reactions=500,purges=20",
+    "full-edits": "posts=100,full_edits=400",
+}
+
+
+def get_image(size: int) -> bytes:
+    output = io.BytesIO()
+    Image.effect_noise((size, size), 64).convert("RGB").save(output, "JPEG")
+    return output.getvalue()
+
+
+def get_padding(name: str, duplicates: float) -> bytes:
+    if zlib.crc32(name.encode()) % 1000 < duplicates * 1000:
+        return b""
+    return name.encode()
+
+
+async def serve_media(
+    image_size: int, duplicates: float
+) -> tuple[aiohttp.web.AppRunner, str, int]:
+    image = get_image(image_size)
+    avatar = get_image(128)
+
+    async def media(request: aiohttp.web.Request) -> aiohttp.web.Response:
+        name = request.match_info["name"]
+        if request.match_info["kind"] != "attachments":
+            body = avatar
+        else:
+            body = image + get_padding(name, duplicates)
+        return aiohttp.web.Response(body=body, content_type="image/jpeg")
+
+    app = aiohttp.web.Application()
+    app.router.add_get("/{kind}/{name}", media)
+    runner = aiohttp.web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = aiohttp.web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}", len(image)
+
+
+class LocalEmoji(discord.PartialEmoji):
+    base_url = ""
+
+    @property
+    def url(self) -> str:
+        return f"{self.base_url}/emojis/{self.id}.png"
+
+
+class FakeRole:
+    def __init__(self, guild: "FakeGuild", role_id: int, name: str) -> None:
+        self.guild = guild
+        self.id = role_id
+        self.name = name
+        self.members: list["FakeMember"] = []
+
+    def is_default(self) -> bool:
+        return self.id == self.guild.id
+
+    async def delete(self) -> None:
+        await self.guild.rest()
+        if self in self.guild.roles:
+            self.guild.roles.remove(self)
+
+
+class FakeMember:
+    def __init__(self, guild: "FakeGuild", user_id: int, base_url: str) -> None:
+        self.guild = guild
+        self.id = user_id
+        self.name = f"membre{user_id}"
+        self.display_name = f"Membre {user_id}"
+        self.global_name = self.display_name
+        self.bot = False
+        self.avatar = f"{base_url}/avatars/{user_id}.png"
+        self.display_avatar = types.SimpleNamespace(
+            key=f"hash{user_id}", url=self.avatar
+        )
+        self.roles: list[FakeRole] = [guild.default_role]
+
+    async def edit(self, roles: list[FakeRole]) -> None:
+        await self.guild.rest()
+        for role in self.roles:
+            if self in role.members:
+                role.members.remove(self)
+        self.roles = [self.guild.default_role, *roles]
+        for role in roles:
+            role.members.append(self)
+
+    async def remove_roles(self, *roles: FakeRole) -> None:
+        await self.edit([role for role in self.roles[1:] if role not in roles])
+
+    async def send(self, *args: Any, **kwargs: Any) -> None:
+        await self.guild.rest()
+
+
+class FakeGuild:
+    def __init__(self, guild_id: int, members: int, base_url: str, latency: float):
+        self.id = guild_id
+        self.latency = latency
+        self.rest_calls = 0
+        self.role_ids = itertools.count(guild_id + 1)
+        self.default_role = FakeRole(self, guild_id, "@everyone")
+        self.roles: list[FakeRole] = [self.default_role]
+        self.members = [
+            FakeMember(self, 10_000 + index, base_url) for index in range(members)
+        ]
+        self.by_id = {member.id: member for member in self.members}
+
+    async def rest(self) -> None:
+        self.rest_calls += 1
+        await asyncio.sleep(self.latency)
+
+    def get_member(self, user_id: int) -> Optional[FakeMember]:
+        return self.by_id.get(user_id)
+
+    async def create_role(self, name: str, display_icon: bytes) -> FakeRole:
+        await self.rest()
+        role = FakeRole(self, next(self.role_ids), name)
+        self.roles.append(role)
+        return role
+
+
+class FakeReaction:
+    def __init__(self, emoji: Any, count: int, me: bool) -> None:
+        self.emoji = emoji
+        self.count = count
+        self.me = me
+
+
+class FakeMessage:
+    def __init__(
+        self,
+        channel: "FakeChannel",
+        message_id: int,
+        author: FakeMember,
+        content: str,
+        attachments: list[types.SimpleNamespace],
+    ) -> None:
+        self.channel = channel
+        self.id = message_id
+        self.author = author
+        self.content = content
+        self.attachments = attachments
+        self.reactions: list[FakeReaction] = []
+        self.type = discord.MessageType.default
+        self.created_at = discord.utils.utcnow()
+
+    def copy(self) -> "FakeMessage":
+        message = FakeMessage(
+            self.channel, self.id, self.author, self.content, list(self.attachments)
+        )
+        message.reactions = list(self.reactions)
+        return message
+
+    async def add_reaction(self, emoji: Any) -> None:
+        await self.channel.guild.rest()
+        for reaction in self.reactions:
+            if str(reaction.emoji) == str(emoji):
+                reaction.count += 1
+                reaction.me = True
+                return
+        self.reactions.append(FakeReaction(emoji, 1, True))
+
+    async def remove_reaction(self, emoji: Any, member: Any) -> None:
+        await self.channel.guild.rest()
+        self.reactions = [
+            reaction for reaction in self.reactions if str(reaction.emoji) != str(emoji)
+        ]
+
+    async def create_thread(self, name: str) -> "FakeChannel":
+        await self.channel.guild.rest()
+        return FakeChannel(self.channel.guild, self.id, name)
+
+    async def delete(self) -> None:
+        await self.channel.guild.rest()
+
+
+class FakeChannel:
+    def __init__(self, guild: FakeGuild, channel_id: int, name: str) -> None:
+        self.guild = guild
+        self.id = channel_id
+        self.name = name
+        self.messages: dict[int, FakeMessage] = {}
+
+    async def send(self, *args: Any, **kwargs: Any) -> None:
+        await self.guild.rest()
+
+    async def fetch_message(self, message_id: int) -> FakeMessage:
+        await self.guild.rest()
+        if message_id not in self.messages:
+            raise discord.NotFound(
+                types.SimpleNamespace(status=404, reason="Not Found"), "unknown"
+            )
+        return self.messages[message_id]
+
+    def get_partial_message(self, message_id: int) -> FakeMessage:
+        return self.messages[message_id]
+
+
+def get_emoji_payload(emoji: Any) -> dict[str, Any]:
+    if isinstance(emoji, discord.PartialEmoji):
+        return emoji.to_dict()
+    return {"id": None, "name": emoji}
+
+
+class Scenario:
+    def __init__(
+        self, args: argparse.Namespace, base_url: str, image_bytes: int
+    ) -> None:
+        self.args = args
+        self.base_url = base_url
+        self.image_bytes = image_bytes
+        self.guild = FakeGuild(main.GUILD_ID, args.users, base_url, args.rest_latency)
+        self.channel = FakeChannel(self.guild, main.CHANNEL_ID, "electrogram")
+        self.message_ids = itertools.count(1_100_000_000_000_000_000)
+        self.attachment_ids = itertools.count(1)
+        self.words = list(main.get_reactions()) or ["carte"]
+        self.emojis: list[Any] = ["👍", "🔥", "🎉", "❤️"]
+        LocalEmoji.base_url = base_url
+        self.emojis.append(LocalEmoji(name="clubelec", id=424242))
+
+    def patch_client(self) -> None:
+        bot = types.SimpleNamespace(id=1, name="electrogram")
+        main.client._connection.user = bot
+        main.client.get_guild = lambda guild_id: self.guild
+        main.client.get_channel = lambda channel_id: self.channel
+        main.client.get_emoji = lambda emoji_id: None
+
+    def get_content(self) -> str:
+        words = random.choices(["voici", "notre", "projet", "du", "jour"], k=20)
+        words += random.sample(self.words, min(3, len(self.words)))
+        random.shuffle(words)
+        return " ".join(words)
+
+    def get_attachments(self, message_id: int) -> list[types.SimpleNamespace]:
+        attachments = []
+        for index in range(self.args.attachments):
+            attachment_id = next(self.attachment_ids)
+            name = f"{message_id}_{attachment_id}.jpg"
+            attachments.append(
+                types.SimpleNamespace(
+                    id=attachment_id,
+                    filename=f"photo{index}.jpg",
+                    size=self.image_bytes
+                    + len(get_padding(name, self.args.duplicates)),
+                    url=f"{self.base_url}/attachments/{name}",
+                )
+            )
+        return attachments
+
+    async def posts(self) -> None:
+        message_id = next(self.message_ids)
+        message = FakeMessage(
+            self.channel,
+            message_id,
+            random.choice(self.guild.members),
+            self.get_content(),
+            self.get_attachments(message_id),
+        )
+        self.channel.messages[message_id] = message
+        await main.on_message(message)
+
+    async def edits(self, full: bool = False) -> None:
+        message = random.choice(list(self.channel.messages.values()))
+        previous = message.copy()
+        if random.random() < 0.5:
+            message.content = self.get_content()
+        else:
+            message.attachments = message.attachments[1:] + self.get_attachments(
+                message.id
+            )[:1]
+        data = {
+            "id": str(message.id),
+            "channel_id": str(self.channel.id),
+            "content": message.content,
+            "attachments": [],
+        }
+        if full:
+            data["author"] = {"id": str(message.author.id)}
+            data["attachments"] = [
+                {
+                    "id": str(attachment.id),
+                    "filename": attachment.filename,
+                    "size": attachment.size,
+                    "url": attachment.url,
+                }
+                for attachment in message.attachments
+            ]
+            if message.reactions:
+                data["reactions"] = [
+                    {
+                        "emoji": get_emoji_payload(reaction.emoji),
+                        "count": reaction.count,
+                        "me": reaction.me,
+                    }
+                    for reaction in message.reactions
+                ]
+        await main.on_raw_message_edit(
+            types.SimpleNamespace(
+                channel_id=self.channel.id,
+                message_id=message.id,
+                data=data,
+                cached_message=previous,
+            )
+        )
+
+    async def full_edits(self) -> None:
+        await self.edits(True)
+
+    async def reactions(self) -> None:
+        message = random.choice(list(self.channel.messages.values())[-5:])
+        emoji = random.choice(self.emojis)
+        payload = types.SimpleNamespace(
+            channel_id=self.channel.id,
+            message_id=message.id,
+            emoji=emoji,
+            user_id=random.choice(self.guild.members).id,
+        )
+        existing = [r for r in message.reactions if str(r.emoji) == str(emoji)]
+        if existing and random.random() < 0.5:
+            existing[0].count -= 1
+            if existing[0].count == 0:
+                message.reactions.remove(existing[0])
+            await main.on_raw_reaction_remove(payload)
+        else:
+            if existing:
+                existing[0].count += 1
+            else:
+                message.reactions.append(FakeReaction(emoji, 1, False))
+            await main.on_raw_reaction_add(payload)
+
+    async def replays(self) -> None:
+        message = random.choice(list(self.channel.messages.values()))
+        if random.random() < 0.5:
+            # redelivered after a restart: only the database remembers the post
+            await main.journal.drain()
+            main.event_deduplicator.forget("message", lambda key: key == message.id)
+        await main.on_message(message)
+
+    async def deletes(self) -> None:
+        message_id = random.choice(list(self.channel.messages))
+        del self.channel.messages[message_id]
+        await main.on_raw_message_delete(
+            types.SimpleNamespace(
+                channel_id=self.channel.id, message_id=message_id, cached_message=None
+            )
+        )
+
+    async def purges(self) -> None:
+        message_ids = random.sample(
+            list(self.channel.messages), min(10, len(self.channel.messages))
+        )
+        for message_id in message_ids:
+            del self.channel.messages[message_id]
+        await main.on_raw_bulk_message_delete(
+            types.SimpleNamespace(
+                channel_id=self.channel.id,
+                message_ids=set(message_ids),
+                cached_messages=[],
+            )
+        )
+
+    async def streaks(self) -> None:
+        main.streak_expiry_cutoff = datetime.date.today() - datetime.timedelta(days=3)
+        await main.streak_update()
+
+    async def seed_streaks(self) -> None:
+        expired = datetime.date.today() - datetime.timedelta(days=2)
+        role = FakeRole(self.guild, next(self.guild.role_ids), "electrogram niveau 4")
+        self.guild.roles.append(role)
+        rows = []
+        for member in self.guild.members[: self.args.users // 2]:
+            member.roles.append(role)
+            role.members.append(member)
+            rows.append((member.id, 3, 3, expired))
+        async with main.db.connection() as conn:
+            await conn.executemany(
+                "INSERT INTO streaks (user_id, streak, max_streak, last_message_date) VALUES (%s, %s, %s, %s)",
+                rows,
+            )
+            await conn.commit()
+
+
+def get_mix(value: str) -> list[tuple[str, int]]:
+    mix = []
+    for item in MIXES.get(value, value).split(","):
+        name, count = item.split("=")
+        mix.append((name.strip(), int(count)))
+    return mix
+
+
+def get_percentile(values: list[float], percentile: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percentile))]
+
+
+async def run_phase(
+    scenario: Scenario, name: str, count: int, concurrency: int
+) -> tuple[list[float], float]:
+    handler = getattr(scenario, name)
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def run() -> None:
+        async with semaphore:
+            started = monotonic()
+            await handler()
+            latencies.append(monotonic() - started)
+
+    started = monotonic()
+    if name in ("posts", "reactions"):
+        await asyncio.gather(*(run() for _ in range(count)))
+    else:
+        for _ in range(count):
+            await run()
+    return latencies, monotonic() - started
+
+
+async def main_benchmark(args: argparse.Namespace) -> None:
+    random.seed(args.seed)
+    runner, base_url, image_bytes = await serve_media(args.image_size, args.duplicates)
+    async with main.db.connection() as conn:
+        await main.create_tables(conn)
+
+    scenario = Scenario(args, base_url, image_bytes)
+    scenario.patch_client()
+
+    started = monotonic()
+    await main.reconcile_members(scenario.guild)
+    print(f"startup reconciliation: {monotonic() - started:.2f}s")
+    await scenario.seed_streaks()
+    main.journal.start()
+
+    print(
+        f"{'phase':>10} {'events':>7} {'events/s':>9} {'p50':>9} {'p99':>9}"
+        f" {'rest calls':>10}"
+    )
+    for name, count in get_mix(args.mix):
+        rest_calls = scenario.guild.rest_calls
+        latencies, elapsed = await run_phase(scenario, name, count, args.concurrency)
+        print(
+            f"{name:>10} {count:>7} {count / elapsed:>9.1f}"
+            f" {get_percentile(latencies, 0.5) * 1000:>7.1f}ms"
+            f" {get_percentile(latencies, 0.99) * 1000:>7.1f}ms"
+            f" {scenario.guild.rest_calls - rest_calls:>10}"
+        )
+
+    started = monotonic()
+    await main.journal.drain()
+    print(f"journal drained in {monotonic() - started:.2f}s", main.journal.stats())
+    started = monotonic()
+    await main.attachment_store.collect(0)
+    print(
+        f"attachment store collected in {monotonic() - started:.2f}s",
+        main.attachment_store.stats(),
+    )
+    print("events:", main.event_deduplicator.stats())
+    print("downloads:", main.downloader.stats())
+    print("thumbnails:", main.thumbnails.stats())
+    print("outbound:", main.outbound.stats())
+    print("database pool:", main.db.stats())
+    print(
+        "peak RSS:",
+        f"{resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MiB (bot),",
+        f"{resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024:.0f} MiB"
+        " (largest exited thumbnail worker)",
+    )
+
+    main.thumbnails.close()
+    await main.downloader.close()
+    await runner.cleanup()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--mix",
+        default="default",
+        help=f"named mix ({', '.join(MIXES)}) or phase=count list",
+    )
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--attachments", type=int, default=2)
+    parser.add_argument("--image-size", type=int, default=1600)
+    parser.add_argument(
+        "--duplicates",
+        type=float,
+        default=0.1,
+        help="share of attachments that are byte-identical reposts",
+    )
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument(
+        "--rest-latency",
+        type=float,
+        default=0.03,
+        help="simulated Discord REST round trip in seconds",
+    )
+    parser.add_argument(
+        "--mysql",
+        action="store_true",
+        help="use the MySQL server from the DB_* variables instead of SQLite",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--keep", action="store_true", help="keep the work folder")
+    args = parser.parse_args()
+    try:
+        asyncio.run(main_benchmark(args))
+    finally:
+        if args.keep:
+            print("work folder:", WORKDIR)
+        else:
+            shutil.rmtree(WORKDIR, ignore_errors=True)
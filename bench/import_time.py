@@ -0,0 +1,79 @@
+"""import-time budget of main.py, measured in fresh interpreters"""
+
+import argparse
+import os
+import re
+import subprocess
+import sys
+
+ROOT: str = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LAZY_MODULES: list[str] = [
+    "numpy",
+    "moviepy",
+    "imageio",
+    "markdown",
+    "emoji",
+    "mysql",
+    "PIL",
+    "aiohttp.web",
+]
+
+
+def measure_import() -> dict[str, tuple[int, int]]:
+    env = dict(os.environ, CHANNEL_ID="0", GUILD_ID="0")
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import main"],
+        cwd=ROOT,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    modules = {}
+    for line in result.stderr.splitlines():
+        match = re.match(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)", line)
+        if match:
+            modules[match[4]] = (int(match[2]), len(match[3]))
+    return modules
+
+
+def main_budget(args: argparse.Namespace) -> int:
+    runs = [measure_import() for _ in range(args.runs)]
+    best = min(runs, key=lambda modules: modules["main"][0])
+    total = best["main"][0] / 1000
+    print(
+        f"import main: {total:.0f} ms",
+        f"(best of {args.runs}, budget {args.budget:.0f} ms)",
+    )
+    top_level = sorted(
+        (
+            (cumulative, name)
+            for name, (cumulative, depth) in best.items()
+            if depth == 3 and name != "main"
+        ),
+        reverse=True,
+    )
+    for cumulative, name in top_level[: args.top]:
+        print(f"{cumulative / 1000:>8.1f} ms  {name}")
+
+    failures = 0
+    eager = [
+        module
+        for module in LAZY_MODULES
+        if any(name == module or name.startswith(f"{module}.") for name in best)
+    ]
+    if eager:
+        print("Imported at load time but meant to be lazy:", ", ".join(eager))
+        failures += 1
+    if total > args.budget:
+        print(f"Import time {total:.0f} ms is over the {args.budget:.0f} ms budget")
+        failures += 1
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--budget", type=float, default=400, help="milliseconds")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10)
+    sys.exit(main_budget(parser.parse_args()))
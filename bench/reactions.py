@@ -0,0 +1,88 @@
+"""micro-benchmark of the reactions.txt matcher against table size and message length"""
+
+import os
+import random
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("CHANNEL_ID", "0")
+os.environ.setdefault("GUILD_ID", "0")
+
+import main  # noqa: E402
+
+TABLE_SIZES: list[int] = [50, 100, 200, 400, 800]
+MESSAGE_LENGTHS: list[int] = [100, 500, 2000, 4000]
+FILLER: list[str] = (
+    "le la les un une des et ou avec pour dans sur notre projet aujourd’hui "
+    "voici nouvelle carte électronique montage test soudure résultat super"
+).split()
+
+
+def get_table(size: int) -> dict[str, str]:
+    reactions = main.get_reactions()
+    table = dict(reactions)
+    index = 0
+    while len(table) < size:
+        table[f"motcle{index}"] = "🔧"
+        index += 1
+    return dict(list(table.items())[:size])
+
+
+def get_message(length: int, table: dict[str, str]) -> str:
+    words = []
+    while sum(len(word) + 1 for word in words) < length:
+        if random.random() < 0.05:
+            words.append(random.choice(list(table)))
+        else:
+            words.append(random.choice(FILLER))
+    return " ".join(words)[:length]
+
+
+def search_per_pattern(table: dict[str, str], content: str) -> list[str]:
+    added_reactions = []
+    for pattern, reaction in table.items():
+        if (
+            re.search(
+                rf"\b{re.escape(pattern)}\b",
+                main.remove_accents(content.lower()),
+            )
+            and reaction not in added_reactions
+        ):
+            added_reactions.append(reaction)
+    return added_reactions
+
+
+def search_matcher(matcher: main.ReactionMatcher, content: str) -> list[str]:
+    return [
+        reaction
+        for reaction, _ in matcher.search(main.remove_accents(content.lower()))
+    ]
+
+
+def main_benchmark() -> None:
+    random.seed(0)
+    print(f"{'patterns':>8} {'chars':>6} {'per pattern':>14} {'matcher':>12} {'speedup':>8}")
+    for size in TABLE_SIZES:
+        table = get_table(size)
+        matcher = main.ReactionMatcher(table)
+        for length in MESSAGE_LENGTHS:
+            content = get_message(length, table)
+            assert search_per_pattern(table, content) == search_matcher(
+                matcher, content
+            )
+            runs = 20
+            before = timeit.timeit(
+                lambda: search_per_pattern(table, content), number=runs
+            )
+            after = timeit.timeit(lambda: search_matcher(matcher, content), number=runs)
+            print(
+                f"{len(table):>8} {length:>6} {before / runs * 1e6:>11.0f} µs"
+                f" {after / runs * 1e6:>9.0f} µs {before / after:>7.1f}x"
+            )
+
+
+if __name__ == "__main__":
+    main_benchmark()
@@ -0,0 +1,328 @@
+"""conformance checks run against every storage backend"""
+
+import argparse
+import asyncio
+import datetime
+import os
+import sys
+import tempfile
+import traceback
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("CHANNEL_ID", "0")
+os.environ.setdefault("GUILD_ID", "0")
+
+import main  # noqa: E402
+
+BASE_ID: int = 9_000_000_000_000_000_000
+USER_ID: int = BASE_ID + 1
+OTHER_USER_ID: int = BASE_ID + 2
+MESSAGE_IDS: list[int] = [BASE_ID + 10 + index for index in range(4)]
+BLOBS: list[str] = [character * 64 for character in "abc"]
+TODAY: datetime.date = datetime.date(2024, 3, 15)
+POSTED: str = "2024-03-15 10:00:00"
+
+
+async def apply(conn: main.DatabaseConnection, statements: list) -> None:
+    await conn.execute_all(statements)
+    await conn.commit()
+
+
+async def cleanup(conn: main.DatabaseConnection) -> None:
+    for table, column in [
+        ("messages", "id"),
+        ("attachments", "message_id"),
+        ("tags", "message_id"),
+        ("users", "id"),
+        ("user_stats", "user_id"),
+        ("streaks", "user_id"),
+        ("backfill_checkpoints", "channel_id"),
+    ]:
+        await conn.execute(f"DELETE FROM {table} WHERE {column} >= %s", (BASE_ID,))
+    await conn.execute_all(
+        [("DELETE FROM blobs WHERE hash = %s", [(digest,) for digest in BLOBS])]
+    )
+    await conn.commit()
+
+
+async def check_messages(conn: main.DatabaseConnection) -> None:
+    storage = main.Storage(conn.backend)
+    first, second = MESSAGE_IDS[:2]
+    await apply(conn, storage.add_message(first, "<p>a</p>", USER_ID, POSTED))
+    await apply(conn, storage.add_message(first, "<p>b</p>", USER_ID, POSTED))
+    rows = await conn.fetchall("SELECT content FROM messages WHERE id = %s", (first,))
+    assert rows == [("<p>a</p>",)], rows
+    await apply(conn, storage.save_message(first, "<p>c</p>", USER_ID, POSTED))
+    await apply(conn, storage.save_message(second, "<p>d</p>", USER_ID, POSTED))
+    await apply(conn, storage.update_message_content(second, "<p>é 🚀</p>"))
+    rows = await conn.fetchall(
+        "SELECT id, content FROM messages WHERE id >= %s ORDER BY id", (BASE_ID,)
+    )
+    assert rows == [(first, "<p>c</p>"), (second, "<p>é 🚀</p>")], rows
+    assert await storage.get_last_message_id(conn) == second
+    assert await storage.get_message_ids(conn, first, second) == [second]
+
+
+async def get_refcounts(conn: main.DatabaseConnection) -> dict[str, int]:
+    return {
+        digest: refcount
+        for digest, _, refcount in await main.Storage(conn.backend).get_blobs(conn)
+        if digest in BLOBS
+    }
+
+
+async def check_attachments(conn: main.DatabaseConnection) -> None:
+    storage = main.Storage(conn.backend)
+    first, spare = MESSAGE_IDS[0], MESSAGE_IDS[2]
+    shared, other = BLOBS[:2]
+    await apply(
+        conn,
+        storage.replace_attachments(
+            first,
+            [
+                (first, "ab/a.jpg", "picture", 800, 600, None, shared, "a.jpg", 1),
+                (first, "ab/b.mp4", "video", 1080, 1920, 12.5, other, "b.mp4", 2),
+            ],
+        ),
+    )
+    await apply(
+        conn,
+        storage.replace_attachments(
+            spare,
+            [(spare, "ab/a.jpg", "picture", 800, 600, None, shared, "copy.jpg", 3)],
+        ),
+    )
+    rows = await storage.get_attachments(conn, first)
+    assert rows == [
+        ("ab/a.jpg", "picture", 800, 600, None, shared, "a.jpg", 1),
+        ("ab/b.mp4", "video", 1080, 1920, 12.5, other, "b.mp4", 2),
+    ], rows
+    assert await storage.get_blob(conn, other) == ("ab/b.mp4", 1080, 1920, 12.5)
+    assert await get_refcounts(conn) == {shared: 2, other: 1}
+
+    await apply(
+        conn,
+        storage.replace_attachments(
+            first,
+            [
+                (first, "ab/a.jpg", "picture", 800, 600, None, shared, "a.jpg", 1),
+                (first, "legacy.png", "picture", None, None, None, None, None, None),
+            ],
+        ),
+    )
+    assert await get_refcounts(conn) == {shared: 2, other: 0}
+    assert (other, "ab/b.mp4") in await storage.get_orphan_blobs(conn)
+    references = await storage.get_blob_references(conn)
+    assert references.get(shared) == 2 and other not in references, references
+    legacy = await storage.get_legacy_attachments(conn)
+    assert [row[1:] for row in legacy if row[1] >= BASE_ID] == [
+        (first, "legacy.png")
+    ], legacy
+
+    await apply(conn, storage.delete_messages([spare]))
+    assert await get_refcounts(conn) == {shared: 1, other: 0}
+    await apply(conn, storage.delete_blobs([shared, other]))
+    assert await get_refcounts(conn) == {shared: 1}
+    await apply(conn, storage.replace_attachments(first, []))
+    await apply(conn, storage.recount_blobs())
+    assert await get_refcounts(conn) == {shared: 0}
+    await apply(conn, storage.delete_blobs([shared]))
+    assert await get_refcounts(conn) == {}
+
+
+async def check_tags(conn: main.DatabaseConnection) -> None:
+    storage = main.Storage(conn.backend)
+    first, second = MESSAGE_IDS[:2]
+    for emoji in ["❤️", "❤️", "❤", "<:club:42>"]:
+        await apply(conn, storage.add_tag(first, emoji, "cœur", None))
+    rows = await conn.fetchall(
+        "SELECT emoji FROM tags WHERE message_id = %s ORDER BY id", (first,)
+    )
+    assert rows == [("❤️",), ("❤",), ("<:club:42>",)], rows
+    await apply(conn, storage.remove_tag(first, "❤"))
+    rows = await conn.fetchall(
+        "SELECT emoji FROM tags WHERE message_id = %s ORDER BY id", (first,)
+    )
+    assert rows == [("❤️",), ("<:club:42>",)], rows
+    await apply(
+        conn,
+        storage.replace_tags(
+            second, [(second, "👍", "pouce", None), (second, "🔥", "feu", None)]
+        ),
+    )
+    recent = await storage.get_recent_tags(conn, 2)
+    assert sorted(recent) == sorted(
+        [(first, "❤️"), (first, "<:club:42>"), (second, "👍"), (second, "🔥")]
+    ), recent
+    await apply(conn, storage.clear_tags(second))
+    assert sorted(await storage.get_recent_tags(conn, 1)) == [(second, None)]
+
+
+async def check_users(conn: main.DatabaseConnection) -> None:
+    storage = main.Storage(conn.backend)
+    await apply(conn, storage.save_user(USER_ID, "alice", "Alice", "a.png", "h1"))
+    await apply(conn, storage.save_user(USER_ID, "alice", "Alice B", "a.png", "h2"))
+    assert await storage.get_user(conn, USER_ID) == ("alice", "Alice B", "h2")
+    await apply(conn, storage.save_user(OTHER_USER_ID, "bob", "Bob", "b.png", None))
+    await apply(conn, storage.update_user(OTHER_USER_ID, "bob", "Bobby", "b.png", "h3"))
+    await apply(
+        conn,
+        storage.update_profiles(
+            [("alice", "Alice C", "h4", USER_ID), ("bob", "Bob", "h5", OTHER_USER_ID)]
+        ),
+    )
+    users = {row[0]: tuple(row[1:]) for row in await storage.get_users(conn)}
+    assert users[USER_ID] == ("alice", "Alice C", "h4"), users[USER_ID]
+    assert users[OTHER_USER_ID] == ("bob", "Bob", "h5"), users[OTHER_USER_ID]
+    assert await storage.get_user(conn, BASE_ID + 99) is None
+
+
+async def check_streaks(conn: main.DatabaseConnection) -> None:
+    storage = main.Storage(conn.backend)
+    await apply(conn, storage.save_streak(USER_ID, 1, 1, TODAY))
+    await apply(conn, storage.save_streak(USER_ID, 2, 2, TODAY + datetime.timedelta(1)))
+    await apply(conn, storage.save_streak(OTHER_USER_ID, 1, None, TODAY))
+    streak = await storage.get_streak(conn, USER_ID)
+    assert streak == (2, 2, TODAY + datetime.timedelta(1)), streak
+    assert isinstance(streak[2], datetime.date)
+    assert await storage.get_streak(conn, BASE_ID + 99) is None
+    streaks = {row[0]: tuple(row[1:]) for row in await storage.get_streaks(conn)}
+    assert streaks[OTHER_USER_ID] == (1, None, TODAY), streaks[OTHER_USER_ID]
+    expired = await storage.get_expired_streaks(
+        conn, TODAY - datetime.timedelta(1), TODAY
+    )
+    assert OTHER_USER_ID in expired and USER_ID not in expired, expired
+
+
+async def check_user_stats(conn: main.DatabaseConnection) -> None:
+    storage = main.Storage(conn.backend)
+    second = MESSAGE_IDS[1]
+    stats = await storage.get_user_stats(conn, USER_ID)
+    assert stats[:7] == (2, 0, 0, 0, 2, 2, 2), stats
+    assert str(stats[7]) == POSTED, stats
+    await apply(
+        conn,
+        storage.replace_attachments(
+            second,
+            [
+                (second, "c.jpg", "picture", 1, 1, None, None, None, 4),
+                (second, "d.mp4", "video", 1, 1, 1.0, None, None, 5),
+                (second, "e.jpg", "picture", 1, 1, None, None, None, 6),
+            ],
+        ),
+    )
+    await apply(conn, storage.add_tag(second, "👍", "pouce", None))
+    await apply(conn, storage.add_tag(second, "👍", "pouce", None))
+    await apply(conn, storage.add_message(second, "<p>d</p>", USER_ID, POSTED))
+    stats = await storage.get_user_stats(conn, USER_ID)
+    assert stats[:5] == (2, 2, 1, 0, 3), stats
+    await apply(conn, storage.remove_tag(second, "👍"))
+    await apply(conn, storage.remove_tag(second, "👍"))
+    assert (await storage.get_user_stats(conn, USER_ID))[4] == 2
+    await apply(conn, storage.add_tag(second, "👍", "pouce", None))
+
+    before = await storage.get_all_user_stats(conn)
+    await apply(conn, storage.rebuild_user_stats())
+    after = await storage.get_all_user_stats(conn)
+    assert sorted(map(tuple, before)) == sorted(map(tuple, after))
+    await apply(conn, storage.replace_attachments(second, []))
+    await apply(conn, storage.clear_tags(second))
+    assert (await storage.get_user_stats(conn, USER_ID))[:5] == (2, 0, 0, 0, 2)
+
+
+async def check_delete_messages(conn: main.DatabaseConnection) -> None:
+    storage = main.Storage(conn.backend)
+    first, third = MESSAGE_IDS[1], MESSAGE_IDS[3]
+    await apply(conn, storage.save_message(third, "x", OTHER_USER_ID, POSTED))
+    await apply(
+        conn,
+        storage.replace_attachments(
+            third, [(third, "x.jpg", "picture", 1, 1, None, BLOBS[2], "x.jpg", 7)]
+        ),
+    )
+    await apply(conn, storage.add_tag(third, "👍", "pouce", None))
+    latest, posted = BASE_ID + 97, "2024-03-16 09:00:00"
+    await apply(conn, storage.add_message(latest, "y", USER_ID, posted))
+    assert str((await storage.get_user_stats(conn, USER_ID))[7]) == posted
+    await apply(conn, storage.delete_messages([third, latest, BASE_ID + 98]))
+    assert await storage.get_message_ids(conn, BASE_ID, BASE_ID + 100) == [
+        MESSAGE_IDS[0],
+        first,
+    ]
+    for table in ("attachments", "tags"):
+        rows = await conn.fetchall(
+            f"SELECT COUNT(*) FROM {table} WHERE message_id = %s", (third,)
+        )
+        assert rows == [(0,)], (table, rows)
+    assert await storage.get_user(conn, OTHER_USER_ID) is None
+    assert await storage.get_user(conn, USER_ID) is not None
+    assert await storage.get_user_stats(conn, OTHER_USER_ID) is None
+    stats = await storage.get_user_stats(conn, USER_ID)
+    assert stats[0] == 2 and str(stats[7]) == POSTED, stats
+    assert await get_refcounts(conn) == {BLOBS[2]: 0}
+
+
+async def check_checkpoints(conn: main.DatabaseConnection) -> None:
+    storage = main.Storage(conn.backend)
+    assert await storage.get_checkpoint(conn, BASE_ID, "full") is None
+    await apply(conn, storage.save_checkpoint(BASE_ID, "full", 10))
+    await apply(conn, storage.save_checkpoint(BASE_ID, "full", 20))
+    await apply(conn, storage.save_checkpoint(BASE_ID, "incremental", 5))
+    assert await storage.get_checkpoint(conn, BASE_ID, "full") == 20
+    await apply(conn, storage.delete_checkpoint(BASE_ID, "full"))
+    assert await storage.get_checkpoint(conn, BASE_ID, "full") is None
+    assert await storage.get_checkpoint(conn, BASE_ID, "incremental") == 5
+
+
+CHECKS: list = [
+    check_messages,
+    check_attachments,
+    check_tags,
+    check_users,
+    check_streaks,
+    check_user_stats,
+    check_delete_messages,
+    check_checkpoints,
+]
+
+
+async def run_backend(backend) -> int:
+    pool = main.DatabasePool(backend, 2, 30, 30)
+    failures = 0
+    async with pool.connection() as conn:
+        await main.create_tables(conn)
+        await cleanup(conn)
+        for check in CHECKS:
+            try:
+                await check(conn)
+                print(f"{backend.name:>6} {check.__name__:<24} ok")
+            except Exception:
+                failures += 1
+                print(f"{backend.name:>6} {check.__name__:<24} FAILED")
+                traceback.print_exc()
+                await conn.rollback()
+        await cleanup(conn)
+    return failures
+
+
+async def main_conformance(args: argparse.Namespace) -> int:
+    failures = 0
+    with tempfile.TemporaryDirectory() as folder:
+        failures += await run_backend(
+            main.SQLiteBackend(os.path.join(folder, "electrogram.sqlite3"))
+        )
+    if args.mysql:
+        failures += await run_backend(main.MySQLBackend(main.DB_CONFIG))
+    return failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--mysql",
+        action="store_true",
+        help="also check the MySQL server from the DB_* variables (rows with ids "
+        f"from {BASE_ID} are written and removed)",
+    )
+    sys.exit(1 if asyncio.run(main_conformance(parser.parse_args())) else 0)
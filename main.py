@@ -1,21 +1,52 @@
 """club elec’s Discord server for the electrogram service"""
 
+from __future__ import annotations
+
+import argparse
+import asyncio
+import bisect
+import collections
+import contextlib
+import contextvars
 import datetime
+import functools
 import glob
+import hashlib
+import io
+import json
+import multiprocessing
 import os
 import re
-from typing import Optional, Union
+import signal
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from time import monotonic
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Hashable,
+    Iterable,
+    Optional,
+    Union,
+)
 from zoneinfo import ZoneInfo
 
 import aiohttp
 import unicodedata
 import discord
-import emoji as emojilib
-import markdown
-import mysql.connector
 from discord.ext import tasks
-from moviepy.editor import VideoFileClip
-from PIL import Image, ImageDraw, ImageFont
+
+if TYPE_CHECKING:
+    import aiohttp.web
+    from PIL import Image, ImageFont
 
 BOT_TOKEN: str = os.environ.get("BOT_TOKEN")
 CHANNEL_ID: int = int(os.environ.get("CHANNEL_ID"))
@@ -29,12 +60,25 @@ DB_CONFIG: dict[str, str] = {
     "host": os.environ.get("DB_HOST", "localhost"),
     "database": os.environ.get("DB_NAME", "electrogram"),
 }
+DB_BACKEND: str = os.environ.get("DB_BACKEND", "mysql")
+DB_FILE: str = os.environ.get("DB_FILE", "shared/electrogram.sqlite3")
+DB_POOL_SIZE: int = int(os.environ.get("DB_POOL_SIZE", "5"))
+DB_POOL_TIMEOUT: float = float(os.environ.get("DB_POOL_TIMEOUT", "30"))
+DB_POOL_PING_INTERVAL: float = float(os.environ.get("DB_POOL_PING_INTERVAL", "30"))
+JOURNAL_FILE: str = os.environ.get("JOURNAL_FILE", "shared/journal.sqlite3")
+JOURNAL_BATCH_SIZE: int = int(os.environ.get("JOURNAL_BATCH_SIZE", "100"))
+JOURNAL_FLUSH_DELAY: float = float(os.environ.get("JOURNAL_FLUSH_DELAY", "0.05"))
+JOURNAL_RETRY_INTERVAL: float = float(os.environ.get("JOURNAL_RETRY_INTERVAL", "5"))
 ATTACHMENTS_FOLDER: str = os.environ.get("ATTACHMENTS_FOLDER", "shared/attachments")
 AVATARS_FOLDER: str = os.environ.get("AVATARS_FOLDER", "shared/avatars")
 FONT_FILE: str = os.environ.get("FONT_FILE", "fonts/VarelaRound-Regular.ttf")
 INPUT_LEVEL_IMG: str = os.environ.get("INPUT_LEVEL_IMG", "img/level_base.png")
 OUTPUT_LEVEL_FOLDER: str = os.environ.get("OUTPUT_LEVEL_FOLDER", "shared/levels")
 CUSTOM_EMOJIS_FOLDER: str = os.environ.get("CUSTOM_EMOJIS_FOLDER", "shared/emojis")
+REACTIONS_FILE: str = os.environ.get("REACTIONS_FILE", "reactions.txt")
+REACTIONS_RELOAD_INTERVAL: float = float(
+    os.environ.get("REACTIONS_RELOAD_INTERVAL", "5")
+)
 ALLOWED_IMG_EXTENSIONS: str = os.environ.get(
     "ALLOWED_IMG_EXTENSIONS", ".png,.jpg,.jpeg,.gif"
 )
@@ -43,73 +87,1521 @@ ALLOWED_AUD_EXTENSIONS: str = os.environ.get("ALLOWED_AUD_EXTENSIONS", ".mp3,.wa
 ALLOWED_EXTENSIONS = (
     ALLOWED_IMG_EXTENSIONS + ALLOWED_VID_EXTENSIONS + ALLOWED_AUD_EXTENSIONS
 )
+HTTP_CONNECTION_LIMIT: int = int(os.environ.get("HTTP_CONNECTION_LIMIT", "32"))
+HTTP_LIMIT_PER_HOST: int = int(os.environ.get("HTTP_LIMIT_PER_HOST", "8"))
+HTTP_KEEPALIVE_TIMEOUT: float = float(os.environ.get("HTTP_KEEPALIVE_TIMEOUT", "60"))
+DOWNLOAD_TIMEOUT: float = float(os.environ.get("DOWNLOAD_TIMEOUT", "120"))
+DOWNLOAD_RETRIES: int = int(os.environ.get("DOWNLOAD_RETRIES", "3"))
+DOWNLOAD_CHUNK_SIZE: int = int(os.environ.get("DOWNLOAD_CHUNK_SIZE", "262144"))
+LEVEL_ICON_PRERENDER: int = int(os.environ.get("LEVEL_ICON_PRERENDER", "31"))
+ROLE_UPDATE_CONCURRENCY: int = int(os.environ.get("ROLE_UPDATE_CONCURRENCY", "4"))
+REACTION_INDEX_SIZE: int = int(os.environ.get("REACTION_INDEX_SIZE", "5000"))
+EVENT_DEDUPE_SIZE: int = int(os.environ.get("EVENT_DEDUPE_SIZE", "10000"))
+EVENT_DEDUPE_TIMEOUT: float = float(os.environ.get("EVENT_DEDUPE_TIMEOUT", "1"))
+BACKFILL_BATCH_SIZE: int = int(os.environ.get("BACKFILL_BATCH_SIZE", "100"))
+METRICS_HOST: str = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT: int = int(os.environ.get("METRICS_PORT", "0"))
+METRICS_LOOP_INTERVAL: float = float(os.environ.get("METRICS_LOOP_INTERVAL", "0.5"))
+METRICS_BUCKETS: tuple[float, ...] = (
+    0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60
+)
+ATTACHMENT_CONCURRENCY: int = int(os.environ.get("ATTACHMENT_CONCURRENCY", "4"))
+ATTACHMENT_GC_DELAY: float = float(os.environ.get("ATTACHMENT_GC_DELAY", "30"))
+ATTACHMENT_GC_GRACE: float = float(os.environ.get("ATTACHMENT_GC_GRACE", "600"))
+THUMBNAIL_SIZE: tuple[int, int] = (500, 500)
+THUMBNAIL_WORKERS: int = int(os.environ.get("THUMBNAIL_WORKERS", "2"))
+THUMBNAIL_QUEUE_SIZE: int = int(os.environ.get("THUMBNAIL_QUEUE_SIZE", "16"))
+THUMBNAIL_TIMEOUT: float = float(os.environ.get("THUMBNAIL_TIMEOUT", "60"))
+THUMBNAIL_TASKS_PER_WORKER: int = int(
+    os.environ.get("THUMBNAIL_TASKS_PER_WORKER", "100")
+)
+VIDEO_POSTER_SECONDS: float = float(os.environ.get("VIDEO_POSTER_SECONDS", "2"))
 
-intents = discord.Intents.all()
+intents = discord.Intents.default()
+intents.members = True
+intents.message_content = True
 client: discord.Client = discord.Client(intents=intents)
 
 time: datetime.time = datetime.time(hour=0, minute=00, tzinfo=ZoneInfo("Europe/Paris"))
+streak_expiry_cutoff: Optional[datetime.date] = None
+options: argparse.Namespace = argparse.Namespace(
+    command="run", full=False, dry_run=False
+)
+
+
+def escape_label_value(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Timer:
+    __slots__ = ("metrics", "key", "started")
+
+    def __init__(self, metrics: "Metrics", key: tuple[str, tuple]) -> None:
+        self.metrics = metrics
+        self.key = key
+
+    def __enter__(self) -> "Timer":
+        self.started = monotonic()
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.metrics.observe(self.key, monotonic() - self.started)
+
+
+class Metrics:
+    def __init__(self, enabled: bool, buckets: tuple[float, ...]) -> None:
+        self.enabled = enabled
+        self.buckets = buckets
+        self.histograms: dict[tuple[str, tuple], list] = {}
+        self.counters: dict[tuple[str, tuple], int] = collections.defaultdict(int)
+        self.collectors: dict[str, Callable[[], dict]] = {}
+        self.runner: Optional[aiohttp.web.AppRunner] = None
+        self.task: Optional[asyncio.Task] = None
+        self.loop_lag = 0.0
+
+    def time(self, name: str, **labels: str) -> Any:
+        if not self.enabled:
+            return null_timer
+        return Timer(self, (name, tuple(sorted(labels.items()))))
+
+    def observe(self, key: tuple[str, tuple], value: float) -> None:
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        histogram[0][bisect.bisect_left(self.buckets, value)] += 1
+        histogram[1] += value
+
+    def count(self, name: str, **labels: str) -> None:
+        if self.enabled:
+            self.counters[(name, tuple(sorted(labels.items())))] += 1
+
+    def handler(self, function: Callable) -> Callable:
+        if not self.enabled:
+            return function
+
+        @functools.wraps(function)
+        async def wrapper(*args: Any, **kwargs: Any) -> Any:
+            with self.time("handler", handler=function.__name__):
+                return await function(*args, **kwargs)
+
+        return wrapper
+
+    async def _watch_loop(self, interval: float) -> None:
+        while True:
+            started = monotonic()
+            await asyncio.sleep(interval)
+            self.loop_lag = max(monotonic() - started - interval, 0.0)
+            self.observe(("loop_lag", ()), self.loop_lag)
+
+    def render(self) -> str:
+        def format_labels(labels: tuple, extra: tuple = ()) -> str:
+            labels = labels + extra
+            if not labels:
+                return ""
+            values = ",".join(
+                f'{key}="{escape_label_value(value)}"' for key, value in labels
+            )
+            return "{" + values + "}"
+
+        lines = []
+        for name in sorted({key[0] for key in self.histograms}):
+            lines.append(f"# TYPE electrogram_{name}_seconds histogram")
+            for (histogram_name, labels), (counts, total) in sorted(
+                self.histograms.items()
+            ):
+                if histogram_name != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip((*self.buckets, "+Inf"), counts):
+                    cumulative += count
+                    lines.append(
+                        f"electrogram_{name}_seconds_bucket"
+                        f"{format_labels(labels, (('le', bound),))} {cumulative}"
+                    )
+                lines.append(
+                    f"electrogram_{name}_seconds_sum{format_labels(labels)} {total}"
+                )
+                lines.append(
+                    f"electrogram_{name}_seconds_count{format_labels(labels)} "
+                    f"{cumulative}"
+                )
+        for name in sorted({key[0] for key in self.counters}):
+            lines.append(f"# TYPE electrogram_{name}_total counter")
+            for (counter_name, labels), value in sorted(self.counters.items()):
+                if counter_name == name:
+                    lines.append(
+                        f"electrogram_{name}_total{format_labels(labels)} {value}"
+                    )
+        lines.append("# TYPE electrogram_loop_lag_last_seconds gauge")
+        lines.append(f"electrogram_loop_lag_last_seconds {self.loop_lag}")
+        for component, collector in self.collectors.items():
+            for key, value in collector().items():
+                lines.append(f"# TYPE electrogram_{component}_{key} gauge")
+                lines.append(f"electrogram_{component}_{key} {value}")
+        return "\n".join(lines) + "\n"
+
+    async def _serve(self, request: aiohttp.web.Request) -> aiohttp.web.Response:
+        import aiohttp.web
+
+        return aiohttp.web.Response(text=self.render(), content_type="text/plain")
+
+    async def start(
+        self, host: str, port: int, collectors: dict[str, Callable[[], dict]]
+    ) -> None:
+        if not self.enabled or self.runner is not None:
+            return
+        import aiohttp.web
 
+        self.collectors = collectors
+        app = aiohttp.web.Application()
+        app.router.add_get("/metrics", self._serve)
+        self.runner = aiohttp.web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await aiohttp.web.TCPSite(self.runner, host, port).start()
+        self.task = asyncio.ensure_future(self._watch_loop(METRICS_LOOP_INTERVAL))
+        print(f"Serving metrics on http://{host}:{port}/metrics")
 
-def create_tables(cursor: mysql.connector.cursor.MySQLCursor) -> None:
+
+null_timer: contextlib.nullcontext = contextlib.nullcontext()
+metrics: Metrics = Metrics(METRICS_PORT > 0, METRICS_BUCKETS)
+
+
+def get_process_age() -> float:
     try:
-        cursor.execute(
-            "CREATE TABLE IF NOT EXISTS messages (id BIGINT PRIMARY KEY, content TEXT, timestamp DATETIME, user_id BIGINT)"
+        with open("/proc/self/stat") as f:
+            ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return 0.0
+    return max(uptime - ticks / os.sysconf("SC_CLK_TCK"), 0.0)
+
+
+class StartupTimer:
+    def __init__(self, started: float) -> None:
+        self.started = started
+        self.last = started
+        self.phases: dict[str, float] = {}
+        self.finished = False
+
+    def mark(self, phase: str) -> None:
+        if self.finished:
+            return
+        now = monotonic()
+        self.phases[phase] = now - self.last
+        self.last = now
+
+    def finish(self, phase: str) -> None:
+        if self.finished:
+            return
+        self.mark(phase)
+        self.finished = True
+        print(
+            f"Started in {self.last - self.started:.2f}s:",
+            ", ".join(f"{name} {seconds:.2f}s" for name, seconds in self.phases.items()),
         )
-        cursor.execute(
-            "CREATE TABLE IF NOT EXISTS tags (id BIGINT AUTO_INCREMENT PRIMARY KEY, message_id BIGINT, emoji VARCHAR(255), description VARCHAR(255), filename VARCHAR(255)) CHARACTER SET utf8mb4 COLLATE utf8mb4_bin"
+
+    def stats(self) -> dict[str, float]:
+        return {**self.phases, "total": self.last - self.started}
+
+
+startup: StartupTimer = StartupTimer(monotonic() - get_process_age())
+
+
+@functools.lru_cache(maxsize=256)
+def get_statement_label(sql: str) -> str:
+    match = re.search(r"\b(?:INTO|FROM|UPDATE|TABLE)\s+(\w+)", sql)
+    verb = sql.split(None, 1)[0].upper()
+    return f"{verb} {match.group(1)}" if match else verb
+
+
+def report_error(name: str, e: BaseException) -> None:
+    print(f"Error in {name}:", e)
+    metrics.count("errors", handler=name)
+
+
+class MySQLBackend:
+    name = "mysql"
+    serial = "BIGINT AUTO_INCREMENT PRIMARY KEY"
+
+    def __init__(self, config: dict[str, str]) -> None:
+        self.config = config
+
+    def table_options(self, collation: str) -> str:
+        return f" CHARACTER SET utf8mb4 COLLATE {collation}"
+
+    def upsert(
+        self,
+        keys: str,
+        columns: Iterable[str] = (),
+        values: Optional[dict[str, str]] = None,
+    ) -> str:
+        assignments = [f"{column} = VALUES({column})" for column in columns]
+        assignments += [
+            f"{column} = {value}" for column, value in (values or {}).items()
+        ]
+        if not assignments:
+            key = keys.split(",")[0]
+            assignments = [f"{key} = {key}"]
+        return f"ON DUPLICATE KEY UPDATE {', '.join(assignments)}"
+
+    @property
+    def errors(self) -> tuple[type[Exception], ...]:
+        import mysql.connector
+
+        return (mysql.connector.Error,)
+
+    def connect(self) -> Any:
+        import mysql.connector
+
+        return mysql.connector.connect(**self.config)
+
+    def ping(self, connection: Any) -> None:
+        connection.ping(reconnect=True, attempts=3, delay=1)
+
+    def is_transient(self, error: Exception) -> bool:
+        import mysql.connector
+
+        return isinstance(
+            error, (mysql.connector.InterfaceError, mysql.connector.OperationalError)
         )
-        cursor.execute(
-            "CREATE TABLE IF NOT EXISTS attachments (id BIGINT AUTO_INCREMENT PRIMARY KEY, message_id BIGINT, filename VARCHAR(255), type VARCHAR(255))"
+
+    def get_fatal_error(self, error: Exception) -> Optional[str]:
+        from mysql.connector import errorcode
+
+        if getattr(error, "errno", None) == errorcode.ER_ACCESS_DENIED_ERROR:
+            return "Access denied."
+        if getattr(error, "errno", None) == errorcode.ER_BAD_DB_ERROR:
+            return "Database does not exist."
+        return None
+
+
+class SQLiteCursor:
+    def __init__(self, cursor: sqlite3.Cursor) -> None:
+        self.cursor = cursor
+
+    @property
+    def rowcount(self) -> int:
+        return self.cursor.rowcount
+
+    def execute(self, sql: str, params: tuple = ()) -> None:
+        self.cursor.execute(sql.replace("%s", "?"), params)
+
+    def executemany(self, sql: str, params: list[tuple]) -> None:
+        self.cursor.executemany(sql.replace("%s", "?"), params)
+
+    def fetchone(self) -> Optional[tuple]:
+        return self.cursor.fetchone()
+
+    def fetchall(self) -> list[tuple]:
+        return self.cursor.fetchall()
+
+    def close(self) -> None:
+        self.cursor.close()
+
+
+class SQLiteConnection:
+    def __init__(self, path: str) -> None:
+        self.connection = sqlite3.connect(
+            path,
+            timeout=30,
+            check_same_thread=False,
+            detect_types=sqlite3.PARSE_DECLTYPES,
         )
-        cursor.execute(
-            "CREATE TABLE IF NOT EXISTS users (id BIGINT PRIMARY KEY, username VARCHAR(255), display_name VARCHAR(255), avatar VARCHAR(255))"
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+
+    @property
+    def in_transaction(self) -> bool:
+        return self.connection.in_transaction
+
+    def cursor(self, buffered: bool = False) -> SQLiteCursor:
+        return SQLiteCursor(self.connection.cursor())
+
+    def commit(self) -> None:
+        self.connection.commit()
+
+    def rollback(self) -> None:
+        self.connection.rollback()
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+class SQLiteBackend:
+    name = "sqlite"
+    serial = "INTEGER PRIMARY KEY AUTOINCREMENT"
+    errors: tuple[type[Exception], ...] = (sqlite3.Error,)
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    def table_options(self, collation: str) -> str:
+        return ""
+
+    def upsert(
+        self,
+        keys: str,
+        columns: Iterable[str] = (),
+        values: Optional[dict[str, str]] = None,
+    ) -> str:
+        assignments = [f"{column} = excluded.{column}" for column in columns]
+        assignments += [
+            f"{column} = {value}" for column, value in (values or {}).items()
+        ]
+        if not assignments:
+            return f"ON CONFLICT ({keys}) DO NOTHING"
+        return f"ON CONFLICT ({keys}) DO UPDATE SET {', '.join(assignments)}"
+
+    def connect(self) -> SQLiteConnection:
+        return SQLiteConnection(self.path)
+
+    def ping(self, connection: SQLiteConnection) -> None:
+        connection.connection.execute("SELECT 1")
+
+    def is_transient(self, error: Exception) -> bool:
+        return isinstance(error, sqlite3.OperationalError) and (
+            "locked" in str(error) or "disk I/O" in str(error)
         )
-        cursor.execute(
-            "CREATE TABLE IF NOT EXISTS streaks (user_id BIGINT PRIMARY KEY, streak INT, max_streak INT, last_message_date DATE)"
+
+    def get_fatal_error(self, error: Exception) -> Optional[str]:
+        return None
+
+
+sqlite3.register_adapter(datetime.date, lambda value: value.isoformat())
+sqlite3.register_adapter(datetime.datetime, lambda value: value.isoformat(" "))
+sqlite3.register_converter(
+    "DATE", lambda value: datetime.date.fromisoformat(value.decode())
+)
+sqlite3.register_converter(
+    "DATETIME", lambda value: datetime.datetime.fromisoformat(value.decode())
+)
+
+
+class DatabaseConnection:
+    def __init__(self, pool: "DatabasePool", connection: Any) -> None:
+        self.pool = pool
+        self.connection = connection
+        self.broken = False
+
+    @property
+    def backend(self) -> Union[MySQLBackend, SQLiteBackend]:
+        return self.pool.backend
+
+    async def _run(self, function, *args) -> Any:
+        try:
+            return await self.pool.run(function, *args)
+        except self.backend.errors as e:
+            if self.backend.is_transient(e):
+                self.broken = True
+            raise
+
+    def _query(self, sql: str, params: tuple, fetch: Optional[str]) -> Any:
+        cursor = self.connection.cursor(buffered=True)
+        try:
+            cursor.execute(sql, params)
+            if fetch == "one":
+                return cursor.fetchone()
+            if fetch == "all":
+                return cursor.fetchall()
+            return cursor.rowcount
+        finally:
+            cursor.close()
+
+    def _query_many(self, sql: str, params: list[tuple]) -> int:
+        cursor = self.connection.cursor()
+        try:
+            cursor.executemany(sql, params)
+            return cursor.rowcount
+        finally:
+            cursor.close()
+
+    async def execute(self, sql: str, params: tuple = ()) -> int:
+        with metrics.time("sql", statement=get_statement_label(sql)):
+            return await self._run(self._query, sql, params, None)
+
+    async def executemany(self, sql: str, params: list[tuple]) -> int:
+        if not params:
+            return 0
+        with metrics.time("sql", statement=get_statement_label(sql)):
+            return await self._run(self._query_many, sql, params)
+
+    async def fetchone(self, sql: str, params: tuple = ()) -> Optional[tuple]:
+        with metrics.time("sql", statement=get_statement_label(sql)):
+            return await self._run(self._query, sql, params, "one")
+
+    async def fetchall(self, sql: str, params: tuple = ()) -> list[tuple]:
+        with metrics.time("sql", statement=get_statement_label(sql)):
+            return await self._run(self._query, sql, params, "all")
+
+    def _query_all(self, statements: list["Statement"]) -> None:
+        cursor = self.connection.cursor()
+        try:
+            for sql, params in statements:
+                if isinstance(params, list):
+                    if params:
+                        cursor.executemany(sql, params)
+                else:
+                    cursor.execute(sql, params)
+        finally:
+            cursor.close()
+
+    async def execute_all(self, statements: list["Statement"]) -> None:
+        with metrics.time("sql", statement="batch"):
+            await self._run(self._query_all, statements)
+
+    async def commit(self) -> None:
+        with metrics.time("sql", statement="COMMIT"):
+            await self._run(self.connection.commit)
+
+    async def rollback(self) -> None:
+        await self._run(self.connection.rollback)
+
+
+class DatabasePool:
+    def __init__(
+        self,
+        backend: Union[MySQLBackend, SQLiteBackend],
+        size: int,
+        timeout: float,
+        ping_interval: float,
+    ) -> None:
+        self.backend = backend
+        self.size = size
+        self.timeout = timeout
+        self.ping_interval = ping_interval
+        self.executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix="db")
+        self.idle: list[tuple[Any, float]] = []
+        self.in_use = 0
+        self.waiting = 0
+        self.acquired = 0
+        self.connects = 0
+        self.discarded = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    @functools.cached_property
+    def semaphore(self) -> asyncio.Semaphore:
+        return asyncio.Semaphore(self.size)
+
+    async def run(self, function, *args) -> Any:
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, function, *args
         )
-    except mysql.connector.Error as err:
-        if err.errno == errorcode.ER_ACCESS_DENIED_ERROR:
-            print("Error: Access denied.")
-        elif err.errno == errorcode.ER_BAD_DB_ERROR:
-            print("Error: Database does not exist.")
-        else:
-            print("Error:", err)
-        exit()
+
+    def _connect(self) -> Any:
+        return self.backend.connect()
+
+    def _check(self, connection: Any) -> Any:
+        try:
+            self.backend.ping(connection)
+            return connection
+        except self.backend.errors:
+            with contextlib.suppress(Exception):
+                connection.close()
+            self.discarded += 1
+            self.connects += 1
+            return self._connect()
+
+    def _release(self, connection: Any, broken: bool) -> bool:
+        if not broken:
+            try:
+                if connection.in_transaction:
+                    connection.rollback()
+                return True
+            except self.backend.errors:
+                pass
+        with contextlib.suppress(Exception):
+            connection.close()
+        return False
+
+    async def _checkout(self) -> Any:
+        if self.idle:
+            connection, released_at = self.idle.pop()
+            if monotonic() - released_at < self.ping_interval:
+                return connection
+            return await self.run(self._check, connection)
+        self.connects += 1
+        return await self.run(self._connect)
+
+    @contextlib.asynccontextmanager
+    async def connection(self) -> AsyncIterator[DatabaseConnection]:
+        started = monotonic()
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self.semaphore.acquire(), self.timeout)
+        finally:
+            self.waiting -= 1
+        waited = monotonic() - started
+        self.total_wait_time += waited
+        self.max_wait_time = max(self.max_wait_time, waited)
+        self.acquired += 1
+        self.in_use += 1
+        try:
+            wrapper = DatabaseConnection(self, await self._checkout())
+            try:
+                yield wrapper
+            finally:
+                if await self.run(self._release, wrapper.connection, wrapper.broken):
+                    self.idle.append((wrapper.connection, monotonic()))
+                else:
+                    self.discarded += 1
+        finally:
+            self.in_use -= 1
+            self.semaphore.release()
+
+    def stats(self) -> dict[str, Union[int, float]]:
+        return {
+            "size": self.size,
+            "idle": len(self.idle),
+            "in_use": self.in_use,
+            "waiting": self.waiting,
+            "acquired": self.acquired,
+            "connects": self.connects,
+            "discarded": self.discarded,
+            "total_wait_time": self.total_wait_time,
+            "max_wait_time": self.max_wait_time,
+        }
+
+    async def close(self) -> None:
+        while self.idle:
+            connection, _ = self.idle.pop()
+            await self.run(self._release, connection, True)
+        self.executor.shutdown(wait=False)
+
+
+db: DatabasePool = DatabasePool(
+    SQLiteBackend(DB_FILE) if DB_BACKEND == "sqlite" else MySQLBackend(DB_CONFIG),
+    DB_POOL_SIZE,
+    DB_POOL_TIMEOUT,
+    DB_POOL_PING_INTERVAL,
+)
+
+Statement = tuple[str, Union[tuple, list[tuple]]]
+MediaInfo = tuple[Optional[int], Optional[int], Optional[float]]
+
+
+def encode_journal_value(value: Any) -> Any:
+    if isinstance(value, datetime.datetime):
+        return {"$datetime": value.isoformat()}
+    if isinstance(value, datetime.date):
+        return {"$date": value.isoformat()}
+    raise TypeError(f"cannot journal {type(value).__name__}")
+
+
+def decode_journal_value(value: dict) -> Any:
+    if "$datetime" in value:
+        return datetime.datetime.fromisoformat(value["$datetime"])
+    if "$date" in value:
+        return datetime.date.fromisoformat(value["$date"])
+    return value
+
+
+class Journal:
+    def __init__(
+        self, path: str, batch_size: int, flush_delay: float, retry_interval: float
+    ) -> None:
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_delay = flush_delay
+        self.retry_interval = retry_interval
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="journal")
+        self.connection: Optional[sqlite3.Connection] = None
+        self.task: Optional[asyncio.Task] = None
+        self.prepare: Optional[Callable[[], Awaitable[None]]] = None
+        self.backlog = 0
+        self.appended = 0
+        self.flushed = 0
+        self.failed = 0
+        self.failing = False
+
+    @functools.cached_property
+    def wakeup(self) -> asyncio.Event:
+        return asyncio.Event()
+
+    @functools.cached_property
+    def lock(self) -> asyncio.Lock:
+        return asyncio.Lock()
+
+    @functools.cached_property
+    def prepared(self) -> asyncio.Event:
+        return asyncio.Event()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self.connection is None:
+            connection = sqlite3.connect(self.path, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=FULL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS entries (id INTEGER PRIMARY KEY AUTOINCREMENT, created REAL, statements TEXT)"
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS failed_entries (id INTEGER PRIMARY KEY, created REAL, statements TEXT, error TEXT)"
+            )
+            connection.commit()
+            self.backlog = connection.execute(
+                "SELECT COUNT(*) FROM entries"
+            ).fetchone()[0]
+            self.connection = connection
+        return self.connection
+
+    async def _run(self, function, *args) -> Any:
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, function, *args
+        )
+
+    def _append(self, payload: str) -> None:
+        connection = self._connect()
+        connection.execute(
+            "INSERT INTO entries (created, statements) VALUES (?, ?)",
+            (datetime.datetime.now().timestamp(), payload),
+        )
+        connection.commit()
+
+    def _read(self) -> list[tuple[int, list[Statement]]]:
+        rows = self._connect().execute(
+            "SELECT id, statements FROM entries ORDER BY id LIMIT ?",
+            (self.batch_size,),
+        )
+        entries = []
+        for entry_id, payload in rows:
+            statements = [
+                (sql, [tuple(row) for row in params] if many else tuple(params))
+                for sql, params, many in json.loads(
+                    payload, object_hook=decode_journal_value
+                )
+            ]
+            entries.append((entry_id, statements))
+        return entries
+
+    def _remove(self, entry_ids: list[int]) -> None:
+        connection = self._connect()
+        connection.executemany(
+            "DELETE FROM entries WHERE id = ?", [(entry_id,) for entry_id in entry_ids]
+        )
+        connection.commit()
+
+    def _fail(self, entry_id: int, error: str) -> None:
+        connection = self._connect()
+        connection.execute(
+            "INSERT INTO failed_entries (id, created, statements, error) SELECT id, created, statements, ? FROM entries WHERE id = ?",
+            (error, entry_id),
+        )
+        connection.execute("DELETE FROM entries WHERE id = ?", (entry_id,))
+        connection.commit()
+
+    async def append(self, statements: list[Statement]) -> None:
+        if not statements:
+            return
+        payload = json.dumps(
+            [
+                (sql, params, isinstance(params, list))
+                for sql, params in statements
+            ],
+            default=encode_journal_value,
+        )
+        await self._run(self._append, payload)
+        self.backlog += 1
+        self.appended += 1
+        self.wakeup.set()
+
+    async def _apply(self, statements: list[Statement]) -> None:
+        async with db.connection() as conn:
+            await conn.execute_all(statements)
+            await conn.commit()
+
+    async def flush(self) -> int:
+        async with self.lock:
+            return await self._flush()
+
+    async def _flush(self) -> int:
+        entries = await self._run(self._read)
+        if not entries:
+            return 0
+        try:
+            await self._apply(
+                [statement for _, statements in entries for statement in statements]
+            )
+            await self._run(self._remove, [entry_id for entry_id, _ in entries])
+        except db.backend.errors as e:
+            if db.backend.is_transient(e):
+                raise
+            for entry_id, statements in entries:
+                try:
+                    await self._apply(statements)
+                    await self._run(self._remove, [entry_id])
+                    self.flushed += 1
+                except db.backend.errors as e:
+                    if db.backend.is_transient(e):
+                        raise
+                    print("Error in Journal: dropping entry", entry_id, e)
+                    await self._run(self._fail, entry_id, str(e))
+                    self.failed += 1
+                self.backlog -= 1
+            return len(entries)
+        self.backlog -= len(entries)
+        self.flushed += len(entries)
+        return len(entries)
+
+    async def drain(self) -> None:
+        while await self.flush():
+            pass
+
+    @contextlib.asynccontextmanager
+    async def drained(self) -> AsyncIterator[None]:
+        async with self.lock:
+            while await self._flush():
+                pass
+            yield
+
+    async def _flush_forever(self) -> None:
+        while True:
+            try:
+                if self.prepare is not None:
+                    await self.prepare()
+                    self.prepare = None
+                self.prepared.set()
+                self.wakeup.clear()
+                await self.drain()
+                self.failing = False
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self.wakeup.wait(), self.retry_interval)
+                await asyncio.sleep(self.flush_delay)
+            except Exception as e:
+                print("Error in Journal:", e)
+                self.failing = True
+                await asyncio.sleep(self.retry_interval)
+
+    def start(self, prepare: Optional[Callable[[], Awaitable[None]]] = None) -> None:
+        if self.task is None or self.task.done():
+            self.prepare = prepare
+            self.task = asyncio.ensure_future(self._flush_forever())
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "backlog": self.backlog,
+            "appended": self.appended,
+            "flushed": self.flushed,
+            "failed": self.failed,
+        }
+
+
+journal: Journal = Journal(
+    JOURNAL_FILE, JOURNAL_BATCH_SIZE, JOURNAL_FLUSH_DELAY, JOURNAL_RETRY_INTERVAL
+)
+
+
+async def add_column(
+    conn: DatabaseConnection, table: str, column: str, definition: str
+) -> None:
+    if conn.backend.name == "sqlite":
+        columns = [row[1] for row in await conn.fetchall(f"PRAGMA table_info({table})")]
+        exists = column in columns
+    else:
+        exists = bool(
+            await conn.fetchall(f"SHOW COLUMNS FROM {table} LIKE %s", (column,))
+        )
+    if not exists:
+        await conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
 
 
-async def create_role_icon(streak: int) -> str:
-    output_image_path = os.path.join(
-        OUTPUT_LEVEL_FOLDER, f"electrogram_level_{streak}.png"
+async def add_index(
+    conn: DatabaseConnection,
+    table: str,
+    name: str,
+    columns: str,
+    unique: Optional[bool] = False,
+) -> None:
+    if conn.backend.name == "sqlite":
+        indexes = await conn.fetchall(
+            "SELECT name FROM sqlite_master WHERE type = 'index' AND name = %s",
+            (name,),
+        )
+    else:
+        indexes = await conn.fetchall(
+            f"SHOW INDEX FROM {table} WHERE Key_name = %s", (name,)
+        )
+    if not indexes:
+        kind = "UNIQUE INDEX" if unique else "INDEX"
+        await conn.execute(f"CREATE {kind} {name} ON {table} ({columns})")
+
+
+async def migrate_1(conn: DatabaseConnection) -> None:
+    backend = conn.backend
+    await conn.execute(
+        "CREATE TABLE IF NOT EXISTS messages (id BIGINT PRIMARY KEY, content TEXT, timestamp DATETIME, user_id BIGINT)"
+    )
+    await conn.execute(
+        f"CREATE TABLE IF NOT EXISTS tags (id {backend.serial}, message_id BIGINT, emoji VARCHAR(255), description VARCHAR(255), filename VARCHAR(255)){backend.table_options('utf8mb4_bin')}"
+    )
+    await conn.execute(
+        f"CREATE TABLE IF NOT EXISTS attachments (id {backend.serial}, message_id BIGINT, filename VARCHAR(255), type VARCHAR(255))"
     )
-    if os.path.exists(output_image_path):
-        return output_image_path
-
-    img = Image.open(INPUT_LEVEL_IMG)
-    font_size = int(min(img.size))
-    font = ImageFont.truetype(FONT_FILE, font_size)
-    draw = ImageDraw.Draw(img)
-    text = str(streak)
-    text_bbox = draw.textbbox((0, 0), text, font=font)
-    text_width = text_bbox[2] - text_bbox[0]
-    text_height = text_bbox[3] - text_bbox[1]
-    width, height = img.size
-    x = (width - text_width) / 2
-    y = (height - text_height) / 2 - text_bbox[1]
-    draw.text((x, y), text, font=font, fill="#e1e0e2")
-    output_image_path = os.path.join(
-        OUTPUT_LEVEL_FOLDER, f"electrogram_level_{streak}.png"
+    await conn.execute(
+        "CREATE TABLE IF NOT EXISTS users (id BIGINT PRIMARY KEY, username VARCHAR(255), display_name VARCHAR(255), avatar VARCHAR(255))"
     )
-    img.save(output_image_path)
-    return output_image_path
+    await conn.execute(
+        "CREATE TABLE IF NOT EXISTS streaks (user_id BIGINT PRIMARY KEY, streak INT, max_streak INT, last_message_date DATE)"
+    )
+
 
+async def migrate_2(conn: DatabaseConnection) -> None:
+    await add_column(conn, "users", "avatar_hash", "VARCHAR(255)")
 
-async def image_to_bytes(image_path: str) -> bytes:
-    with open(image_path, "rb") as image_file:
-        return image_file.read()
 
+async def migrate_3(conn: DatabaseConnection) -> None:
+    if conn.backend.name == "mysql":
+        for table in ("messages", "attachments", "users", "streaks"):
+            await conn.execute(
+                f"ALTER TABLE {table} CONVERT TO CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci"
+            )
+        await conn.execute(
+            "ALTER TABLE tags CONVERT TO CHARACTER SET utf8mb4 COLLATE utf8mb4_bin"
+        )
+        await conn.execute(
+            "DELETE duplicate FROM tags duplicate JOIN tags original ON duplicate.message_id = original.message_id AND duplicate.emoji = original.emoji AND duplicate.id > original.id"
+        )
+    else:
+        await conn.execute(
+            "DELETE FROM tags WHERE id NOT IN (SELECT MIN(id) FROM tags GROUP BY message_id, emoji)"
+        )
+    await conn.commit()
+    await add_index(conn, "tags", "tags_message_emoji", "message_id, emoji", True)
+    await add_index(conn, "attachments", "attachments_message", "message_id")
+    await add_index(conn, "messages", "messages_user", "user_id")
+    await add_index(conn, "streaks", "streaks_last_message_date", "last_message_date")
 
-def get_reactions() -> dict:
-    with open("reactions.txt", "r") as file:
+
+async def migrate_4(conn: DatabaseConnection) -> None:
+    await conn.execute(
+        f"CREATE TABLE IF NOT EXISTS backfill_checkpoints (channel_id BIGINT, mode VARCHAR(16), last_message_id BIGINT, updated_at DATETIME, PRIMARY KEY (channel_id, mode)){conn.backend.table_options('utf8mb4_unicode_ci')}"
+    )
+
+
+async def migrate_5(conn: DatabaseConnection) -> None:
+    await add_column(conn, "attachments", "width", "INT")
+    await add_column(conn, "attachments", "height", "INT")
+    await add_column(conn, "attachments", "duration", "DOUBLE")
+
+
+async def migrate_6(conn: DatabaseConnection) -> None:
+    await conn.execute(
+        f"CREATE TABLE IF NOT EXISTS blobs (hash CHAR(64) PRIMARY KEY, filename VARCHAR(255), width INT, height INT, duration DOUBLE, refcount INT, created_at DATETIME, updated_at DATETIME){conn.backend.table_options('utf8mb4_unicode_ci')}"
+    )
+    await add_column(conn, "attachments", "hash", "CHAR(64)")
+    await add_column(conn, "attachments", "name", "VARCHAR(255)")
+    await add_index(conn, "attachments", "attachments_hash", "hash")
+    await add_index(conn, "blobs", "blobs_refcount", "refcount")
+
+
+async def migrate_7(conn: DatabaseConnection) -> None:
+    await conn.execute(
+        "CREATE TABLE IF NOT EXISTS user_stats (user_id BIGINT PRIMARY KEY, posts INT, pictures INT, videos INT, audios INT, tags INT, streak INT, max_streak INT, last_post DATETIME, updated_at DATETIME)"
+    )
+    await add_index(conn, "user_stats", "user_stats_posts", "posts")
+    await conn.execute_all(Storage(conn.backend).rebuild_user_stats())
+
+
+async def migrate_8(conn: DatabaseConnection) -> None:
+    await add_column(conn, "attachments", "attachment_id", "BIGINT")
+
+
+MIGRATIONS: list[tuple[int, str, Any]] = [
+    (1, "initial tables", migrate_1),
+    (2, "users.avatar_hash", migrate_2),
+    (3, "indexes, unique tags and utf8mb4 everywhere", migrate_3),
+    (4, "backfill checkpoints", migrate_4),
+    (5, "attachments dimensions and duration", migrate_5),
+    (6, "content-addressed attachment blobs", migrate_6),
+    (7, "per-user statistics", migrate_7),
+    (8, "attachments.attachment_id", migrate_8),
+]
+
+
+async def prepare_database() -> None:
+    async with db.connection() as conn:
+        await create_tables(conn)
+
+
+async def create_tables(conn: DatabaseConnection) -> None:
+    try:
+        await conn.execute(
+            "CREATE TABLE IF NOT EXISTS schema_version (version INT PRIMARY KEY, description VARCHAR(255), applied_at DATETIME)"
+        )
+        locked = conn.backend.name == "mysql"
+        if locked:
+            await conn.fetchone("SELECT GET_LOCK('electrogram_schema', 60)")
+        try:
+            current = (
+                await conn.fetchone(
+                    "SELECT COALESCE(MAX(version), 0) FROM schema_version"
+                )
+            )[0]
+            for version, description, migrate in MIGRATIONS:
+                if version <= current:
+                    continue
+                started = monotonic()
+                await migrate(conn)
+                await conn.execute(
+                    "INSERT INTO schema_version (version, description, applied_at) VALUES (%s, %s, CURRENT_TIMESTAMP)",
+                    (version, description),
+                )
+                await conn.commit()
+                print(
+                    f"Applied schema migration {version} ({description})",
+                    f"in {monotonic() - started:.2f}s",
+                )
+        finally:
+            if locked:
+                await conn.fetchone("SELECT RELEASE_LOCK('electrogram_schema')")
+    except conn.backend.errors as err:
+        message = conn.backend.get_fatal_error(err)
+        if message is None:
+            raise
+        print("Error:", message)
+        sys.exit(1)
+
+
+async def get_schema_version(conn: DatabaseConnection) -> int:
+    try:
+        result = await conn.fetchone(
+            "SELECT COALESCE(MAX(version), 0) FROM schema_version"
+        )
+    except conn.backend.errors:
+        return 0
+    return result[0]
+
+
+def get_placeholders(values: list) -> str:
+    return ", ".join(["%s"] * len(values))
+
+
+class Storage:
+    def __init__(self, backend: Union[MySQLBackend, SQLiteBackend]) -> None:
+        self.backend = backend
+
+    def add_message(
+        self, message_id: int, content: str, user_id: int, timestamp: str
+    ) -> list[Statement]:
+        return self.add_user_post(message_id, user_id, timestamp) + [
+            (
+                f"INSERT INTO messages (id, content, user_id, timestamp) VALUES (%s, %s, %s, %s) {self.backend.upsert('id')}",
+                (message_id, content, user_id, timestamp),
+            )
+        ]
+
+    def save_message(
+        self, message_id: int, content: str, user_id: int, timestamp: str
+    ) -> list[Statement]:
+        return self.add_user_post(message_id, user_id, timestamp) + [
+            (
+                f"INSERT INTO messages (id, content, user_id, timestamp) VALUES (%s, %s, %s, %s) {self.backend.upsert('id', ['content'])}",
+                (message_id, content, user_id, timestamp),
+            )
+        ]
+
+    def update_message_content(self, message_id: int, content: str) -> list[Statement]:
+        return [
+            ("UPDATE messages SET content = %s WHERE id = %s", (content, message_id))
+        ]
+
+    def delete_messages(self, message_ids: list[int]) -> list[Statement]:
+        if not message_ids:
+            return []
+        placeholders = get_placeholders(message_ids)
+        ids = tuple(message_ids)
+        return (
+            [
+                (
+                    f"UPDATE user_stats SET posts = posts - (SELECT COUNT(*) FROM messages WHERE messages.user_id = user_stats.user_id AND messages.id IN ({placeholders})), pictures = pictures - (SELECT COUNT(*) FROM attachments JOIN messages ON messages.id = attachments.message_id WHERE messages.user_id = user_stats.user_id AND messages.id IN ({placeholders}) AND attachments.type = 'picture'), videos = videos - (SELECT COUNT(*) FROM attachments JOIN messages ON messages.id = attachments.message_id WHERE messages.user_id = user_stats.user_id AND messages.id IN ({placeholders}) AND attachments.type = 'video'), audios = audios - (SELECT COUNT(*) FROM attachments JOIN messages ON messages.id = attachments.message_id WHERE messages.user_id = user_stats.user_id AND messages.id IN ({placeholders}) AND attachments.type = 'audio'), tags = tags - (SELECT COUNT(*) FROM tags JOIN messages ON messages.id = tags.message_id WHERE messages.user_id = user_stats.user_id AND messages.id IN ({placeholders})), last_post = CASE WHEN last_post IN (SELECT timestamp FROM messages WHERE messages.user_id = user_stats.user_id AND messages.id IN ({placeholders})) THEN (SELECT MAX(timestamp) FROM messages WHERE messages.user_id = user_stats.user_id AND messages.id NOT IN ({placeholders})) ELSE last_post END, updated_at = CURRENT_TIMESTAMP WHERE user_id IN (SELECT user_id FROM messages WHERE id IN ({placeholders}))",
+                    ids * 8,
+                ),
+                self.mark_blobs(message_ids),
+                (f"DELETE FROM messages WHERE id IN ({placeholders})", ids),
+                (f"DELETE FROM attachments WHERE message_id IN ({placeholders})", ids),
+                (f"DELETE FROM tags WHERE message_id IN ({placeholders})", ids),
+            ]
+            + self.count_blob_references()
+            + [
+                (
+                    "DELETE FROM users WHERE id IN (SELECT user_id FROM user_stats WHERE posts = 0)",
+                    (),
+                ),
+                ("DELETE FROM user_stats WHERE posts = 0", ()),
+            ]
+        )
+
+    def replace_attachments(
+        self, message_id: int, rows: list[tuple]
+    ) -> list[Statement]:
+        blobs = {
+            row[6]: (row[6], row[1], row[3], row[4], row[5])
+            for row in rows
+            if row[6] is not None
+        }
+        return [
+            self.mark_blobs([message_id]),
+            self.count_message_attachments(message_id, "-"),
+            ("DELETE FROM attachments WHERE message_id = %s", (message_id,)),
+            (
+                f"INSERT INTO blobs (hash, filename, width, height, duration, created_at) VALUES (%s, %s, %s, %s, %s, CURRENT_TIMESTAMP) {self.backend.upsert('hash')}",
+                list(blobs.values()),
+            ),
+            (
+                "INSERT INTO attachments (message_id, filename, type, width, height, duration, hash, name, attachment_id) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)",
+                rows,
+            ),
+            self.mark_blobs([message_id]),
+            self.count_message_attachments(message_id, "+"),
+        ] + self.count_blob_references()
+
+    def add_orphan_blobs(self, rows: list[tuple]) -> list[Statement]:
+        return [
+            (
+                f"INSERT INTO blobs (hash, filename, width, height, duration, refcount, created_at, updated_at) VALUES (%s, %s, %s, %s, %s, 0, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP) {self.backend.upsert('hash')}",
+                [(row[6], row[1], row[3], row[4], row[5]) for row in rows],
+            )
+        ]
+
+    def mark_blobs(self, message_ids: list[int]) -> Statement:
+        return (
+            f"UPDATE blobs SET refcount = NULL WHERE hash IN (SELECT hash FROM attachments WHERE message_id IN ({get_placeholders(message_ids)}))",
+            tuple(message_ids),
+        )
+
+    def count_blob_references(self) -> list[Statement]:
+        return [
+            (
+                "UPDATE blobs SET refcount = (SELECT COUNT(*) FROM attachments WHERE attachments.hash = blobs.hash), updated_at = CURRENT_TIMESTAMP WHERE refcount IS NULL",
+                (),
+            )
+        ]
+
+    def recount_blobs(self) -> list[Statement]:
+        return [("UPDATE blobs SET refcount = NULL", ())] + self.count_blob_references()
+
+    def add_user_post(
+        self, message_id: int, user_id: int, timestamp: str
+    ) -> list[Statement]:
+        return [
+            (
+                f"INSERT INTO user_stats (user_id, posts, pictures, videos, audios, tags, streak, max_streak, updated_at) VALUES (%s, 0, 0, 0, 0, 0, (SELECT streak FROM streaks WHERE user_id = %s), (SELECT max_streak FROM streaks WHERE user_id = %s), CURRENT_TIMESTAMP) {self.backend.upsert('user_id')}",
+                (user_id, user_id, user_id),
+            ),
+            (
+                "UPDATE user_stats SET posts = posts + 1, last_post = CASE WHEN last_post IS NULL OR last_post < %s THEN %s ELSE last_post END, updated_at = CURRENT_TIMESTAMP WHERE user_id = %s AND NOT EXISTS (SELECT 1 FROM messages WHERE id = %s)",
+                (timestamp, timestamp, user_id, message_id),
+            ),
+        ]
+
+    def count_message_attachments(self, message_id: int, sign: str) -> Statement:
+        return (
+            f"UPDATE user_stats SET pictures = pictures {sign} (SELECT COUNT(*) FROM attachments WHERE message_id = %s AND type = 'picture'), videos = videos {sign} (SELECT COUNT(*) FROM attachments WHERE message_id = %s AND type = 'video'), audios = audios {sign} (SELECT COUNT(*) FROM attachments WHERE message_id = %s AND type = 'audio'), updated_at = CURRENT_TIMESTAMP WHERE user_id = (SELECT user_id FROM messages WHERE id = %s)",
+            (message_id,) * 4,
+        )
+
+    def count_message_tags(self, message_id: int, sign: str) -> Statement:
+        return (
+            f"UPDATE user_stats SET tags = tags {sign} (SELECT COUNT(*) FROM tags WHERE message_id = %s), updated_at = CURRENT_TIMESTAMP WHERE user_id = (SELECT user_id FROM messages WHERE id = %s)",
+            (message_id, message_id),
+        )
+
+    def rebuild_user_stats(self) -> list[Statement]:
+        return [
+            ("DELETE FROM user_stats", ()),
+            (
+                "INSERT INTO user_stats (user_id) SELECT DISTINCT user_id FROM messages WHERE user_id IS NOT NULL",
+                (),
+            ),
+            (
+                "UPDATE user_stats SET posts = (SELECT COUNT(*) FROM messages WHERE messages.user_id = user_stats.user_id), pictures = (SELECT COUNT(*) FROM attachments JOIN messages ON messages.id = attachments.message_id WHERE messages.user_id = user_stats.user_id AND attachments.type = 'picture'), videos = (SELECT COUNT(*) FROM attachments JOIN messages ON messages.id = attachments.message_id WHERE messages.user_id = user_stats.user_id AND attachments.type = 'video'), audios = (SELECT COUNT(*) FROM attachments JOIN messages ON messages.id = attachments.message_id WHERE messages.user_id = user_stats.user_id AND attachments.type = 'audio'), tags = (SELECT COUNT(*) FROM tags JOIN messages ON messages.id = tags.message_id WHERE messages.user_id = user_stats.user_id), streak = (SELECT streak FROM streaks WHERE streaks.user_id = user_stats.user_id), max_streak = (SELECT max_streak FROM streaks WHERE streaks.user_id = user_stats.user_id), last_post = (SELECT MAX(timestamp) FROM messages WHERE messages.user_id = user_stats.user_id), updated_at = CURRENT_TIMESTAMP WHERE posts IS NULL",
+                (),
+            ),
+        ]
+
+    def delete_blobs(self, digests: list[str]) -> list[Statement]:
+        return [
+            (
+                "DELETE FROM blobs WHERE hash = %s AND refcount = 0",
+                [(digest,) for digest in digests],
+            )
+        ]
+
+    def adopt_attachment(
+        self, attachment_id: int, filename: str, digest: str, name: str, info: MediaInfo
+    ) -> list[Statement]:
+        return [
+            (
+                f"INSERT INTO blobs (hash, filename, width, height, duration, created_at) VALUES (%s, %s, %s, %s, %s, CURRENT_TIMESTAMP) {self.backend.upsert('hash')}",
+                (digest, filename, *info),
+            ),
+            (
+                "UPDATE attachments SET filename = %s, hash = %s, name = %s, width = %s, height = %s, duration = %s WHERE id = %s",
+                (filename, digest, name, *info, attachment_id),
+            ),
+        ]
+
+    def add_tag(
+        self,
+        message_id: int,
+        emoji: str,
+        description: str,
+        filename: Optional[str],
+    ) -> list[Statement]:
+        return [
+            (
+                "UPDATE user_stats SET tags = tags + 1, updated_at = CURRENT_TIMESTAMP WHERE user_id = (SELECT user_id FROM messages WHERE id = %s) AND NOT EXISTS (SELECT 1 FROM tags WHERE message_id = %s AND emoji = %s)",
+                (message_id, message_id, emoji),
+            ),
+            (
+                f"INSERT INTO tags (message_id, emoji, description, filename) VALUES (%s, %s, %s, %s) {self.backend.upsert('message_id, emoji')}",
+                (message_id, emoji, description, filename),
+            ),
+        ]
+
+    def remove_tag(self, message_id: int, emoji: str) -> list[Statement]:
+        return [
+            (
+                "UPDATE user_stats SET tags = tags - 1, updated_at = CURRENT_TIMESTAMP WHERE user_id = (SELECT user_id FROM messages WHERE id = %s) AND EXISTS (SELECT 1 FROM tags WHERE message_id = %s AND emoji = %s)",
+                (message_id, message_id, emoji),
+            ),
+            (
+                "DELETE FROM tags WHERE message_id = %s AND emoji = %s",
+                (message_id, emoji),
+            ),
+        ]
+
+    def clear_tags(self, message_id: int) -> list[Statement]:
+        return [
+            self.count_message_tags(message_id, "-"),
+            ("DELETE FROM tags WHERE message_id = %s", (message_id,)),
+        ]
+
+    def replace_tags(
+        self, message_id: int, rows: list[tuple[int, str, str, Optional[str]]]
+    ) -> list[Statement]:
+        return [
+            self.count_message_tags(message_id, "-"),
+            ("DELETE FROM tags WHERE message_id = %s", (message_id,)),
+            (
+                "INSERT INTO tags (message_id, emoji, description, filename) VALUES (%s, %s, %s, %s)",
+                rows,
+            ),
+            self.count_message_tags(message_id, "+"),
+        ]
+
+    def save_user(
+        self,
+        user_id: int,
+        username: str,
+        display_name: str,
+        avatar: str,
+        avatar_hash: Optional[str],
+    ) -> list[Statement]:
+        return [
+            (
+                f"INSERT INTO users (id, username, display_name, avatar, avatar_hash) VALUES (%s, %s, %s, %s, %s) {self.backend.upsert('id', ['username', 'display_name', 'avatar', 'avatar_hash'])}",
+                (user_id, username, display_name, avatar, avatar_hash),
+            )
+        ]
+
+    def update_user(
+        self,
+        user_id: int,
+        username: str,
+        display_name: str,
+        avatar: str,
+        avatar_hash: Optional[str],
+    ) -> list[Statement]:
+        return [
+            (
+                "UPDATE users SET avatar = %s, username = %s, display_name = %s, avatar_hash = %s WHERE id = %s",
+                (avatar, username, display_name, avatar_hash, user_id),
+            )
+        ]
+
+    def update_profiles(
+        self, rows: list[tuple[str, str, Optional[str], int]]
+    ) -> list[Statement]:
+        return [
+            (
+                "UPDATE users SET username = %s, display_name = %s, avatar_hash = %s WHERE id = %s",
+                rows,
+            )
+        ]
+
+    def save_streak(
+        self,
+        user_id: int,
+        streak: int,
+        max_streak: Optional[int],
+        last_message_date: datetime.date,
+    ) -> list[Statement]:
+        return [
+            (
+                f"INSERT INTO streaks (user_id, streak, max_streak, last_message_date) VALUES (%s, %s, %s, %s) {self.backend.upsert('user_id', ['streak', 'max_streak', 'last_message_date'])}",
+                (user_id, streak, max_streak, last_message_date),
+            ),
+            (
+                "UPDATE user_stats SET streak = %s, max_streak = %s, updated_at = CURRENT_TIMESTAMP WHERE user_id = %s",
+                (streak, max_streak, user_id),
+            ),
+        ]
+
+    def save_checkpoint(
+        self, channel_id: int, mode: str, last_message_id: int
+    ) -> list[Statement]:
+        return [
+            (
+                f"INSERT INTO backfill_checkpoints (channel_id, mode, last_message_id, updated_at) VALUES (%s, %s, %s, CURRENT_TIMESTAMP) {self.backend.upsert('channel_id, mode', ['last_message_id', 'updated_at'])}",
+                (channel_id, mode, last_message_id),
+            )
+        ]
+
+    def delete_checkpoint(self, channel_id: int, mode: str) -> list[Statement]:
+        return [
+            (
+                "DELETE FROM backfill_checkpoints WHERE channel_id = %s AND mode = %s",
+                (channel_id, mode),
+            )
+        ]
+
+    async def get_user(
+        self, conn: DatabaseConnection, user_id: int
+    ) -> Optional[tuple[str, str, Optional[str]]]:
+        result = await conn.fetchone(
+            "SELECT username, display_name, avatar_hash FROM users WHERE id = %s",
+            (user_id,),
+        )
+        return tuple(result) if result is not None else None
+
+    async def get_users(self, conn: DatabaseConnection) -> list[tuple]:
+        return await conn.fetchall(
+            "SELECT id, username, display_name, avatar_hash FROM users"
+        )
+
+    async def get_streak(
+        self, conn: DatabaseConnection, user_id: int
+    ) -> Optional[tuple[int, Optional[int], datetime.date]]:
+        result = await conn.fetchone(
+            "SELECT streak, max_streak, last_message_date FROM streaks WHERE user_id = %s",
+            (user_id,),
+        )
+        return tuple(result) if result is not None else None
+
+    async def get_streaks(self, conn: DatabaseConnection) -> list[tuple]:
+        return await conn.fetchall(
+            "SELECT user_id, streak, max_streak, last_message_date FROM streaks"
+        )
+
+    async def get_expired_streaks(
+        self, conn: DatabaseConnection, after: datetime.date, until: datetime.date
+    ) -> list[int]:
+        rows = await conn.fetchall(
+            "SELECT user_id FROM streaks WHERE last_message_date > %s AND last_message_date <= %s",
+            (after, until),
+        )
+        return [row[0] for row in rows]
+
+    async def get_user_stats(
+        self, conn: DatabaseConnection, user_id: int
+    ) -> Optional[tuple]:
+        result = await conn.fetchone(
+            "SELECT posts, pictures, videos, audios, tags, streak, max_streak, last_post FROM user_stats WHERE user_id = %s",
+            (user_id,),
+        )
+        return tuple(result) if result is not None else None
+
+    async def get_all_user_stats(self, conn: DatabaseConnection) -> list[tuple]:
+        return await conn.fetchall(
+            "SELECT user_id, posts, pictures, videos, audios, tags, streak, max_streak, last_post FROM user_stats"
+        )
+
+    async def get_recent_tags(
+        self, conn: DatabaseConnection, limit: int
+    ) -> list[tuple[int, Optional[str]]]:
+        return await conn.fetchall(
+            "SELECT m.id, t.emoji FROM (SELECT id FROM messages ORDER BY id DESC LIMIT %s) m LEFT JOIN tags t ON t.message_id = m.id",
+            (limit,),
+        )
+
+    async def get_message_ids(
+        self, conn: DatabaseConnection, after: int, until: int
+    ) -> list[int]:
+        rows = await conn.fetchall(
+            "SELECT id FROM messages WHERE id > %s AND id <= %s", (after, until)
+        )
+        return [row[0] for row in rows]
+
+    async def get_last_message_id(self, conn: DatabaseConnection) -> Optional[int]:
+        return (await conn.fetchone("SELECT MAX(id) FROM messages"))[0]
+
+    async def message_exists(self, conn: DatabaseConnection, message_id: int) -> bool:
+        return (
+            await conn.fetchone("SELECT 1 FROM messages WHERE id = %s", (message_id,))
+        ) is not None
+
+    async def get_checkpoint(
+        self, conn: DatabaseConnection, channel_id: int, mode: str
+    ) -> Optional[int]:
+        result = await conn.fetchone(
+            "SELECT last_message_id FROM backfill_checkpoints WHERE channel_id = %s AND mode = %s",
+            (channel_id, mode),
+        )
+        return result[0] if result is not None else None
+
+    async def get_attachments(
+        self, conn: DatabaseConnection, message_id: int
+    ) -> list[tuple]:
+        return await conn.fetchall(
+            "SELECT filename, type, width, height, duration, hash, name, attachment_id FROM attachments WHERE message_id = %s ORDER BY id",
+            (message_id,),
+        )
+
+    async def get_legacy_attachments(self, conn: DatabaseConnection) -> list[tuple]:
+        return await conn.fetchall(
+            "SELECT id, message_id, filename FROM attachments WHERE hash IS NULL"
+        )
+
+    async def get_blob(
+        self, conn: DatabaseConnection, digest: str
+    ) -> Optional[tuple[str, Optional[int], Optional[int], Optional[float]]]:
+        result = await conn.fetchone(
+            "SELECT filename, width, height, duration FROM blobs WHERE hash = %s",
+            (digest,),
+        )
+        return tuple(result) if result is not None else None
+
+    async def get_blobs(self, conn: DatabaseConnection) -> list[tuple]:
+        return await conn.fetchall("SELECT hash, filename, refcount FROM blobs")
+
+    async def get_orphan_blobs(
+        self, conn: DatabaseConnection
+    ) -> list[tuple[str, str]]:
+        return await conn.fetchall(
+            "SELECT hash, filename FROM blobs WHERE refcount = 0"
+        )
+
+    async def get_blob_references(self, conn: DatabaseConnection) -> dict[str, int]:
+        rows = await conn.fetchall(
+            "SELECT hash, COUNT(*) FROM attachments WHERE hash IS NOT NULL GROUP BY hash"
+        )
+        return dict(rows)
+
+    async def get_attachment_filenames(self, conn: DatabaseConnection) -> set[str]:
+        rows = await conn.fetchall("SELECT filename FROM attachments")
+        return {row[0] for row in rows}
+
+
+storage: Storage = Storage(db.backend)
+
+
+class RoleIconRenderer:
+    def __init__(self, base_path: str, font_path: str, folder: str) -> None:
+        self.base_path = base_path
+        self.font_path = font_path
+        self.folder = folder
+        self.base: Optional[Image.Image] = None
+        self.font: Optional[ImageFont.FreeTypeFont] = None
+        self.lock = threading.Lock()
+        self.icons: dict[int, bytes] = {}
+        self.pending: set[int] = set()
+        self.task: Optional[asyncio.Task] = None
+
+    def _render(self, streak: int) -> bytes:
+        output_image_path = os.path.join(self.folder, f"electrogram_level_{streak}.png")
+        if os.path.exists(output_image_path):
+            with open(output_image_path, "rb") as image_file:
+                return image_file.read()
+
+        from PIL import Image, ImageDraw, ImageFont
+
+        with self.lock:
+            if self.base is None:
+                self.base = Image.open(self.base_path)
+                self.base.load()
+                self.font = ImageFont.truetype(self.font_path, int(min(self.base.size)))
+            img = self.base.copy()
+            draw = ImageDraw.Draw(img)
+            text = str(streak)
+            text_bbox = draw.textbbox((0, 0), text, font=self.font)
+            text_width = text_bbox[2] - text_bbox[0]
+            text_height = text_bbox[3] - text_bbox[1]
+            width, height = img.size
+            x = (width - text_width) / 2
+            y = (height - text_height) / 2 - text_bbox[1]
+            draw.text((x, y), text, font=self.font, fill="#e1e0e2")
+        buffer = io.BytesIO()
+        img.save(buffer, "PNG")
+        icon = buffer.getvalue()
+        with open(output_image_path, "wb") as image_file:
+            image_file.write(icon)
+        return icon
+
+    async def get(self, streak: int) -> bytes:
+        icon = self.icons.get(streak)
+        if icon is None:
+            icon = self.icons[streak] = await asyncio.to_thread(self._render, streak)
+        return icon
+
+    async def _prerender(self) -> None:
+        while self.pending:
+            streak = min(self.pending)
+            self.pending.discard(streak)
+            try:
+                await self.get(streak)
+            except Exception as e:
+                print("Error in RoleIconRenderer:", e)
+
+    def prerender(self, levels: list[int]) -> None:
+        self.pending.update(level for level in levels if level not in self.icons)
+        if self.pending and (self.task is None or self.task.done()):
+            self.task = asyncio.ensure_future(self._prerender())
+
+
+class LevelRoleRegistry:
+    prefix = "electrogram niveau "
+
+    def __init__(self) -> None:
+        self.roles: dict[int, discord.Role] = {}
+
+    def level_of(self, role: discord.Role) -> Optional[int]:
+        level = role.name[len(self.prefix) :]
+        if role.name.startswith(self.prefix) and level.isdigit():
+            return int(level)
+        return None
+
+    def load(self, guild: discord.Guild) -> None:
+        self.roles = {}
+        for role in guild.roles:
+            self.add(role)
+
+    def add(self, role: discord.Role) -> None:
+        streak = self.level_of(role)
+        if streak is not None:
+            self.roles.setdefault(streak, role)
+
+    def remove(self, role: discord.Role) -> None:
+        streak = self.level_of(role)
+        if streak is not None and self.roles.get(streak) == role:
+            del self.roles[streak]
+            for other in role.guild.roles:
+                if other != role and self.level_of(other) == streak:
+                    self.roles[streak] = other
+                    break
+
+    def get(self, streak: int) -> Optional[discord.Role]:
+        return self.roles.get(streak)
+
+
+role_icons: RoleIconRenderer = RoleIconRenderer(
+    INPUT_LEVEL_IMG, FONT_FILE, OUTPUT_LEVEL_FOLDER
+)
+level_roles: LevelRoleRegistry = LevelRoleRegistry()
+
+
+def get_reactions(path: str = REACTIONS_FILE) -> dict:
+    with open(path, "r") as file:
         lines = file.readlines()
     reactions = {
         line.split("=")[0].strip(): line.split("=")[1].strip() for line in lines
@@ -117,7 +1609,197 @@ def get_reactions() -> dict:
     return reactions
 
 
-reactions = get_reactions()
+def get_custom_emoji_id(reaction: str) -> Optional[int]:
+    if reaction.startswith("<:") and reaction.endswith(">"):
+        return int(reaction.split(":")[-1][:-1])
+    return None
+
+
+class ReactionMatcher:
+    word = re.compile(r"\w")
+
+    def __init__(self, reactions: dict[str, str]) -> None:
+        self.patterns = [pattern for pattern in reactions if pattern]
+        self.reactions = [
+            (reactions[pattern], get_custom_emoji_id(reactions[pattern]))
+            for pattern in self.patterns
+        ]
+        self.edges = [
+            (bool(self.word.match(pattern[0])), bool(self.word.match(pattern[-1])))
+            for pattern in self.patterns
+        ]
+        self.goto: list[dict[str, int]] = [{}]
+        self.fail: list[int] = [0]
+        self.output: list[list[int]] = [[]]
+        for index, pattern in enumerate(self.patterns):
+            state = 0
+            for char in pattern:
+                next_state = self.goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append([])
+                    self.goto[state][char] = next_state
+                state = next_state
+            self.output[state].append(index)
+        queue = collections.deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[next_state] = self.goto[fallback].get(char, 0)
+                self.output[next_state] = (
+                    self.output[next_state] + self.output[self.fail[next_state]]
+                )
+
+    def _is_word(self, text: str, position: int) -> bool:
+        return 0 <= position < len(text) and bool(self.word.match(text[position]))
+
+    def search(self, text: str) -> list[tuple[str, Optional[int]]]:
+        goto, fail, output = self.goto, self.fail, self.output
+        matched = set()
+        state = 0
+        for position, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for index in output[state]:
+                if index in matched:
+                    continue
+                first, last = self.edges[index]
+                start = position - len(self.patterns[index]) + 1
+                if self._is_word(text, start - 1) != first and (
+                    self._is_word(text, position + 1) != last
+                ):
+                    matched.add(index)
+        found = []
+        for index in sorted(matched):
+            if self.reactions[index] not in found:
+                found.append(self.reactions[index])
+        return found
+
+
+class ReactionTable:
+    def __init__(self, path: str, check_interval: float) -> None:
+        self.path = path
+        self.check_interval = check_interval
+        self.checked_at = monotonic()
+        self.modified_at = os.stat(path).st_mtime_ns
+        self.reactions = get_reactions(path)
+        self.current = ReactionMatcher(self.reactions)
+
+    def matcher(self) -> ReactionMatcher:
+        if monotonic() - self.checked_at >= self.check_interval:
+            self.checked_at = monotonic()
+            try:
+                modified_at = os.stat(self.path).st_mtime_ns
+                if modified_at != self.modified_at:
+                    reactions = get_reactions(self.path)
+                    self.current = ReactionMatcher(reactions)
+                    self.reactions = reactions
+                    self.modified_at = modified_at
+                    print(f"Reloaded {len(reactions)} reactions from {self.path}")
+            except Exception as e:
+                print("Error in ReactionTable:", e)
+        return self.current
+
+
+reaction_table: ReactionTable = ReactionTable(
+    REACTIONS_FILE, REACTIONS_RELOAD_INTERVAL
+)
+
+
+def get_message_reactions(content: str) -> list[tuple[str, Optional[int]]]:
+    return reaction_table.matcher().search(remove_accents(content.lower()))
+
+
+class Outbound:
+    def __init__(self) -> None:
+        self.post_counter: contextvars.ContextVar[Optional[list[int]]] = (
+            contextvars.ContextVar("post_counter", default=None)
+        )
+        self.calls = 0
+        self.posts = 0
+        self.post_calls = 0
+        self.latency = 0.0
+        self.max_latency = 0.0
+
+    async def call(self, awaitable: Any) -> Any:
+        self.calls += 1
+        counter = self.post_counter.get()
+        if counter is not None:
+            counter[0] += 1
+        with metrics.time("discord", call=getattr(awaitable, "__qualname__", "call")):
+            return await awaitable
+
+    def track(self) -> list[int]:
+        counter = [0]
+        self.post_counter.set(counter)
+        return counter
+
+    def record(self, started: float, counter: list[int]) -> None:
+        latency = monotonic() - started
+        self.posts += 1
+        self.post_calls += counter[0]
+        self.latency += latency
+        self.max_latency = max(self.max_latency, latency)
+
+    def stats(self) -> dict[str, Union[int, float]]:
+        return {
+            "calls": self.calls,
+            "posts": self.posts,
+            "calls_per_post": self.post_calls / self.posts if self.posts else 0.0,
+            "publish_latency": self.latency / self.posts if self.posts else 0.0,
+            "publish_latency_max": self.max_latency,
+        }
+
+
+outbound: Outbound = Outbound()
+
+
+def get_tag(
+    emoji: Union[str, discord.Emoji, discord.PartialEmoji],
+) -> tuple[str, str, Optional[str]]:
+    emoji_name = str(emoji)
+    if isinstance(emoji, (discord.Emoji, discord.PartialEmoji)) and emoji.id:
+        return emoji_name, emoji_name.split(":")[1], emoji_cache.filename(emoji.id)
+    import emoji as emojilib
+
+    emoji_description = (
+        str(emojilib.demojize(emoji_name, language="fr"))
+        .replace(":", "")
+        .replace("_", " ")
+    )
+    return emoji_name, emoji_description, None
+
+
+async def add_message_reactions(
+    message: discord.Message, matched: list[tuple[str, Optional[int]]]
+) -> None:
+    emojis = []
+    for reaction, emoji_id in matched:
+        if emoji_id is None:
+            emojis.append(reaction)
+        else:
+            emoji = client.get_emoji(emoji_id)
+            if emoji:
+                emojis.append(emoji)
+    for emoji in emojis:
+        try:
+            await outbound.call(message.add_reaction(emoji))
+        except Exception as e:
+            print("Error in add_message_reactions:", e)
+
+
+def render_content(content: str) -> str:
+    import markdown
+
+    with metrics.time("markdown"):
+        return markdown.markdown(detect_link(content))
 
 
 def detect_link(text: str) -> str:
@@ -126,50 +1808,235 @@ def detect_link(text: str) -> str:
     return formated_text
 
 
-async def download_file(url: str, destination: str) -> None:
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url) as resp:
-            if resp.status == 200:
-                with open(destination, "wb") as f:
-                    f.write(await resp.read())
+class DownloadError(Exception):
+    def __init__(self, message: str, status: Optional[int] = None) -> None:
+        super().__init__(message)
+        self.status = status
+
+
+class Downloader:
+    def __init__(
+        self,
+        limit: int,
+        limit_per_host: int,
+        keepalive_timeout: float,
+        timeout: float,
+        retries: int,
+        chunk_size: int,
+    ) -> None:
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.timeout = timeout
+        self.retries = retries
+        self.chunk_size = chunk_size
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.downloaded = 0
+        self.retried = 0
+        self.failed = 0
+        self.bytes = 0
+
+    def _session(self) -> aiohttp.ClientSession:
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                keepalive_timeout=self.keepalive_timeout,
+                ttl_dns_cache=300,
+            )
+            self.session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+        return self.session
+
+    async def _stream(self, url: str, destination: str) -> tuple[int, str]:
+        folder = os.path.dirname(destination) or "."
+        descriptor, temporary_path = tempfile.mkstemp(
+            dir=folder, prefix=".", suffix=".part"
+        )
+        digest = hashlib.sha256()
+        size = 0
+
+        def write(f: Any, chunk: bytes) -> None:
+            f.write(chunk)
+            digest.update(chunk)
+
+        try:
+            with os.fdopen(descriptor, "wb") as f:
+                async with self._session().get(url) as resp:
+                    if resp.status != 200:
+                        raise DownloadError(
+                            f"{url} answered HTTP {resp.status}", resp.status
+                        )
+                    async for chunk in resp.content.iter_chunked(self.chunk_size):
+                        await asyncio.to_thread(write, f, chunk)
+                        size += len(chunk)
+            os.chmod(temporary_path, 0o644)
+            os.replace(temporary_path, destination)
+            return size, digest.hexdigest()
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.remove(temporary_path)
+            raise
+
+    async def fetch(self, url: str, destination: str) -> str:
+        for attempt in range(self.retries + 1):
+            try:
+                with metrics.time("download"):
+                    size, digest = await self._stream(url, destination)
+                self.bytes += size
+                self.downloaded += 1
+                return digest
+            except DownloadError as e:
+                error = e
+                if e.status not in (429, 500, 502, 503, 504):
+                    break
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = DownloadError(f"{url}: {e!r}")
+            if attempt < self.retries:
+                self.retried += 1
+                await asyncio.sleep(0.5 * 2**attempt)
+        self.failed += 1
+        raise error
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "downloaded": self.downloaded,
+            "retried": self.retried,
+            "failed": self.failed,
+            "bytes": self.bytes,
+        }
+
+    async def close(self) -> None:
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+
+downloader: Downloader = Downloader(
+    HTTP_CONNECTION_LIMIT,
+    HTTP_LIMIT_PER_HOST,
+    HTTP_KEEPALIVE_TIMEOUT,
+    DOWNLOAD_TIMEOUT,
+    DOWNLOAD_RETRIES,
+    DOWNLOAD_CHUNK_SIZE,
+)
+
 
-    _, extension = os.path.splitext(destination)
+def get_media_kind(path: str) -> Optional[str]:
+    _, extension = os.path.splitext(path)
     extension = extension[1:].lower()
-    thumbnail_path = f"{destination}.thumb.jpg"
 
     if extension in ALLOWED_IMG_EXTENSIONS:
-        generate_image_thumbnail(destination, thumbnail_path)
+        return "picture"
     elif extension in ALLOWED_VID_EXTENSIONS:
-        generate_video_thumbnail(destination, thumbnail_path)
+        return "video"
+    else:
+        return None
+
 
-    resize_thumbnail(thumbnail_path, max_size=(500, 500))
-    if extension in ALLOWED_VID_EXTENSIONS:
-        add_play_icon_to_thumbnail(thumbnail_path)
+async def render_media(path: str) -> Optional[MediaInfo]:
+    kind = get_media_kind(path)
+    if kind is None:
+        return None
+
+    try:
+        return await thumbnails.render(path, f"{path}.thumb.jpg", kind)
+    except Exception as e:
+        print("Error in render_media:", path, e)
+        return None
+
+
+async def download_file(url: str, destination: str) -> Optional[MediaInfo]:
+    await downloader.fetch(url, destination)
+    return await render_media(destination)
+
+
+def parse_video_info(output: str) -> MediaInfo:
+    output = output.split("\nOutput #", 1)[0]
+    duration = re.search(r"Duration: (\d+):(\d+):(\d+(?:\.\d+)?)", output)
+    size = re.search(r"Video: .*?, (\d+)x(\d+)", output)
+    rotation = re.search(r"rotat(?:e\s*:|ion of)\s*(-?[\d.]+)", output)
+    width, height = (int(size[1]), int(size[2])) if size else (None, None)
+    if rotation and round(float(rotation[1])) % 180 == 90:
+        width, height = height, width
+    seconds = (
+        int(duration[1]) * 3600 + int(duration[2]) * 60 + float(duration[3])
+        if duration
+        else None
+    )
+    return width, height, seconds
 
 
-def resize_thumbnail(thumbnail_path: str, max_size: tuple[int, int]) -> None:
-    thumbnail = Image.open(thumbnail_path)
-    thumbnail.thumbnail(max_size, Image.Resampling.LANCZOS)
-    thumbnail.save(thumbnail_path)
+@functools.cache
+def get_ffmpeg_binary() -> str:
+    from moviepy.config import get_setting
 
+    return get_setting("FFMPEG_BINARY")
+
+
+def probe_video(video_path: str, timeout: float) -> MediaInfo:
+    result = subprocess.run(
+        [get_ffmpeg_binary(), "-hide_banner", "-nostdin", "-i", video_path],
+        capture_output=True,
+        timeout=timeout,
+    )
+    return parse_video_info(result.stderr.decode(errors="replace"))
+
+
+def get_video_poster(video_path: str, timeout: float) -> tuple[Image.Image, MediaInfo]:
+    from PIL import Image
+
+    position = VIDEO_POSTER_SECONDS
+    while True:
+        result = subprocess.run(
+            [
+                get_ffmpeg_binary(),
+                "-hide_banner",
+                "-nostdin",
+                "-noaccurate_seek",
+                "-ss",
+                f"{position:.3f}",
+                "-skip_frame",
+                "nokey",
+                "-i",
+                video_path,
+                "-map",
+                "0:v:0",
+                "-frames:v",
+                "1",
+                "-f",
+                "image2pipe",
+                "-c:v",
+                "ppm",
+                "-",
+            ],
+            capture_output=True,
+            timeout=timeout,
+        )
+        info = parse_video_info(result.stderr.decode(errors="replace"))
+        if result.stdout:
+            poster = Image.open(io.BytesIO(result.stdout))
+            poster.load()
+            return poster, info
+        if position == 0:
+            raise ValueError(f"no video frame found in {video_path}")
+        position = info[2] / 2 if info[2] and info[2] / 2 < position else 0
 
-def generate_image_thumbnail(image_path: str, thumbnail_path: str) -> None:
-    image = Image.open(image_path)
-    image = image.convert("RGB")
-    max_size = (500, 500)
-    image.thumbnail(max_size)
-    image.save(thumbnail_path)
 
+def probe_media(source: str, kind: str, timeout: float) -> MediaInfo:
+    if kind == "video":
+        return probe_video(source, timeout)
+    from PIL import Image
 
-def generate_video_thumbnail(video_path: str, thumbnail_path: str) -> None:
-    video = VideoFileClip(video_path)
-    thumbnail = video.get_frame(0)
-    Image.fromarray(thumbnail).save(thumbnail_path, "JPEG")
-    video.close()
+    with Image.open(source) as image:
+        return image.width, image.height, None
 
 
-def add_play_icon_to_thumbnail(thumbnail_path: str) -> None:
-    thumbnail = Image.open(thumbnail_path)
+def add_play_icon(thumbnail: Image.Image) -> None:
+    from PIL import Image, ImageDraw
+
     icon_size = min(thumbnail.width, thumbnail.height) // 2
     play_icon = Image.new("RGBA", (icon_size, icon_size), (0, 0, 0, 0))
     draw = ImageDraw.Draw(play_icon)
@@ -187,13 +2054,444 @@ def add_play_icon_to_thumbnail(thumbnail_path: str) -> None:
         ],
         fill="#e1e0e299",
     )
-    play_icon = play_icon.resize((icon_size, icon_size))
     thumbnail.paste(
         play_icon,
         (thumbnail.width // 2 - icon_size // 2, thumbnail.height // 2 - icon_size // 2),
         play_icon,
     )
-    thumbnail.save(thumbnail_path)
+
+
+def thumbnail_timeout(signum: int, frame: Any) -> None:
+    raise TimeoutError("thumbnail generation timed out")
+
+
+def render_thumbnail(
+    source: str, destination: str, kind: str, timeout: float
+) -> MediaInfo:
+    from PIL import Image
+
+    signal.signal(signal.SIGALRM, thumbnail_timeout)
+    signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        if kind == "video":
+            thumbnail, info = get_video_poster(source, timeout)
+        else:
+            thumbnail = Image.open(source)
+            info = (thumbnail.width, thumbnail.height, None)
+            thumbnail.draft("RGB", THUMBNAIL_SIZE)
+        thumbnail = thumbnail.convert("RGB")
+        thumbnail.thumbnail(THUMBNAIL_SIZE, Image.Resampling.LANCZOS)
+        if kind == "video":
+            add_play_icon(thumbnail)
+        temporary_path = f"{destination}.tmp"
+        try:
+            thumbnail.save(temporary_path, "JPEG")
+            os.replace(temporary_path, destination)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.remove(temporary_path)
+            raise
+        return info
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+
+
+class ThumbnailPipeline:
+    def __init__(
+        self, workers: int, queue_size: int, timeout: float, tasks_per_worker: int
+    ) -> None:
+        self.workers = workers
+        self.timeout = timeout
+        self.tasks_per_worker = tasks_per_worker
+        self.queue_size = queue_size
+        self.executor: Optional[ProcessPoolExecutor] = None
+        self.submitted = 0
+        self.retiring: set[asyncio.Future] = set()
+        self.pending = 0
+        self.rendered = 0
+        self.failed = 0
+        self.timeouts = 0
+
+    @functools.cached_property
+    def slots(self) -> asyncio.Semaphore:
+        return asyncio.Semaphore(self.queue_size)
+
+    def _executor(self) -> ProcessPoolExecutor:
+        if self.submitted >= self.workers * self.tasks_per_worker:
+            self._recycle()
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+            self.submitted = 0
+        self.submitted += 1
+        return self.executor
+
+    def _recycle(self) -> None:
+        executor, self.executor = self.executor, None
+        if executor is None:
+            return
+        retiring = asyncio.ensure_future(asyncio.to_thread(executor.shutdown, True))
+        self.retiring.add(retiring)
+        retiring.add_done_callback(self.retiring.discard)
+
+    async def render(self, source: str, destination: str, kind: str) -> MediaInfo:
+        self.pending += 1
+        try:
+            async with self.slots:
+                future = asyncio.get_running_loop().run_in_executor(
+                    self._executor(),
+                    render_thumbnail,
+                    source,
+                    destination,
+                    kind,
+                    self.timeout,
+                )
+                try:
+                    with metrics.time("thumbnail", kind=kind):
+                        info = await asyncio.wait_for(future, self.timeout + 5)
+                except asyncio.TimeoutError:
+                    self.timeouts += 1
+                    self._recycle()
+                    raise
+                except BrokenProcessPool:
+                    self._recycle()
+                    raise
+                self.rendered += 1
+                return info
+        except BaseException:
+            self.failed += 1
+            raise
+        finally:
+            self.pending -= 1
+
+    async def probe(self, source: str) -> MediaInfo:
+        kind = get_media_kind(source)
+        if kind is None:
+            return None, None, None
+        try:
+            with metrics.time("probe", kind=kind):
+                return await asyncio.to_thread(probe_media, source, kind, self.timeout)
+        except Exception as e:
+            print("Error in probe:", source, e)
+            return None, None, None
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "workers": self.workers,
+            "pending": self.pending,
+            "rendered": self.rendered,
+            "failed": self.failed,
+            "timeouts": self.timeouts,
+        }
+
+    def close(self) -> None:
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+
+thumbnails: ThumbnailPipeline = ThumbnailPipeline(
+    THUMBNAIL_WORKERS,
+    THUMBNAIL_QUEUE_SIZE,
+    THUMBNAIL_TIMEOUT,
+    THUMBNAIL_TASKS_PER_WORKER,
+)
+
+
+BLOB_NAME: re.Pattern = re.compile(r"([0-9a-f]{2})/\1[0-9a-f]{62}(\.[^/]*)?")
+
+
+def hash_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(DOWNLOAD_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def remove_attachment_files(filenames: list[str]) -> int:
+    removed = 0
+    for filename in filenames:
+        for path in (filename, f"{filename}.thumb.jpg"):
+            with contextlib.suppress(FileNotFoundError):
+                size = os.path.getsize(path)
+                os.remove(path)
+                removed += size
+    return removed
+
+
+def remove_message_files(
+    message_ids: Iterable[int], kept: Optional[set[str]] = None
+) -> int:
+    prefixes = {str(message_id) for message_id in message_ids}
+    filenames = []
+    with contextlib.suppress(FileNotFoundError), os.scandir(
+        ATTACHMENTS_FOLDER
+    ) as entries:
+        for entry in entries:
+            prefix, separator, _ = entry.name.partition("_")
+            filename = f"{ATTACHMENTS_FOLDER}/{entry.name}"
+            if (
+                separator
+                and prefix in prefixes
+                and not entry.name.endswith(".thumb.jpg")
+                and filename not in (kept or ())
+            ):
+                filenames.append(filename)
+    return remove_attachment_files(filenames)
+
+
+class AttachmentStore:
+    def __init__(
+        self, folder: str, concurrency: int, collect_delay: float, grace: float
+    ) -> None:
+        self.folder = folder
+        self.concurrency = concurrency
+        self.collect_delay = collect_delay
+        self.grace = grace
+        self.pending: dict[str, asyncio.Task] = {}
+        self.used: dict[str, float] = {}
+        self.released: set[int] = set()
+        self.deferred: Optional[float] = None
+        self.timer: Optional[asyncio.TimerHandle] = None
+        self.task: Optional[asyncio.Task] = None
+        self.stored = 0
+        self.deduplicated = 0
+        self.collected = 0
+        self.reclaimed = 0
+
+    @functools.cached_property
+    def slots(self) -> asyncio.Semaphore:
+        return asyncio.Semaphore(self.concurrency)
+
+    @functools.cached_property
+    def wakeup(self) -> asyncio.Event:
+        return asyncio.Event()
+
+    def path(self, digest: str, extension: str) -> str:
+        return f"{self.folder}/{digest[:2]}/{digest}{extension.lower()}"
+
+    def find(self, digest: str) -> Optional[str]:
+        for filename in glob.glob(f"{self.folder}/{digest[:2]}/{digest}.*"):
+            if not filename.endswith(".thumb.jpg"):
+                return filename
+        return None
+
+    def place(self, digest: str, source: str, extension: str) -> tuple[str, bool]:
+        filename = self.find(digest)
+        if filename is not None:
+            return filename, False
+        filename = self.path(digest, extension)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        os.replace(source, filename)
+        return filename, True
+
+    async def _store(
+        self, digest: str, staging: str, extension: str
+    ) -> tuple[str, MediaInfo]:
+        filename, placed = await asyncio.to_thread(
+            self.place, digest, staging, extension
+        )
+        if placed:
+            self.stored += 1
+            return filename, await render_media(filename) or (None, None, None)
+
+        self.deduplicated += 1
+        if get_media_kind(filename) is not None and not os.path.exists(
+            f"{filename}.thumb.jpg"
+        ):
+            return filename, await render_media(filename) or (None, None, None)
+        try:
+            async with db.connection() as conn:
+                blob = await storage.get_blob(conn, digest)
+        except Exception as e:
+            report_error("AttachmentStore", e)
+            blob = None
+        if blob is not None:
+            return filename, blob[1:]
+        return filename, await thumbnails.probe(filename)
+
+    async def ingest(self, url: str, name: str) -> tuple[str, str, MediaInfo]:
+        _, extension = os.path.splitext(name)
+        descriptor, staging = tempfile.mkstemp(
+            dir=self.folder, prefix=".", suffix=".incoming"
+        )
+        os.close(descriptor)
+        try:
+            digest = await downloader.fetch(url, staging)
+            self.used[digest] = monotonic()
+            task = self.pending.get(digest)
+            if task is not None:
+                self.deduplicated += 1
+                filename, info = await asyncio.shield(task)
+                return filename, digest, info
+            task = asyncio.ensure_future(self._store(digest, staging, extension))
+            self.pending[digest] = task
+            try:
+                filename, info = await asyncio.shield(task)
+            finally:
+                if self.pending.get(digest) is task:
+                    del self.pending[digest]
+            return filename, digest, info
+        finally:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(staging)
+
+    async def adopt(self, path: str) -> tuple[str, str, MediaInfo]:
+        digest = await asyncio.to_thread(hash_file, path)
+        _, extension = os.path.splitext(path)
+        filename, placed = await asyncio.to_thread(self.place, digest, path, extension)
+        if placed:
+            with contextlib.suppress(FileNotFoundError):
+                await asyncio.to_thread(
+                    os.replace, f"{path}.thumb.jpg", f"{filename}.thumb.jpg"
+                )
+            self.stored += 1
+        else:
+            self.deduplicated += 1
+            self.reclaimed += await asyncio.to_thread(remove_attachment_files, [path])
+        if get_media_kind(filename) is not None and not os.path.exists(
+            f"{filename}.thumb.jpg"
+        ):
+            info = await render_media(filename)
+        else:
+            info = await thumbnails.probe(filename)
+        return filename, digest, info or (None, None, None)
+
+    def release(self, message_ids: Iterable[int] = ()) -> None:
+        self.released.update(message_ids)
+        self.wakeup.set()
+
+    async def collect(self, grace: Optional[float] = None) -> int:
+        grace = self.grace if grace is None else grace
+        cutoff = monotonic() - grace
+        self.used = {
+            digest: used for digest, used in self.used.items() if used > cutoff
+        }
+        released, self.released = self.released, set()
+        if released:
+            self.reclaimed += await asyncio.to_thread(remove_message_files, released)
+        async with journal.drained():
+            async with db.connection() as conn:
+                orphans = await storage.get_orphan_blobs(conn)
+                recent = [
+                    self.used[digest] for digest, _ in orphans if digest in self.used
+                ]
+                orphans = [
+                    (digest, filename)
+                    for digest, filename in orphans
+                    if digest not in self.used and digest not in self.pending
+                ]
+                await conn.execute_all(
+                    storage.delete_blobs([digest for digest, _ in orphans])
+                )
+                await conn.commit()
+        self.reclaimed += await asyncio.to_thread(
+            remove_attachment_files, [filename for _, filename in orphans]
+        )
+        self.collected += len(orphans)
+        self.deferred = min(recent) + grace if recent else None
+        return len(orphans)
+
+    async def _collect_forever(self) -> None:
+        while True:
+            await self.wakeup.wait()
+            await asyncio.sleep(self.collect_delay)
+            self.wakeup.clear()
+            try:
+                await self.collect()
+            except Exception as e:
+                print("Error in AttachmentStore:", e)
+                self.wakeup.set()
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if self.deferred is not None:
+                self.timer = asyncio.get_running_loop().call_later(
+                    max(self.deferred - monotonic(), 0), self.wakeup.set
+                )
+
+    def start(self) -> None:
+        if self.task is None or self.task.done():
+            self.wakeup.set()
+            self.task = asyncio.ensure_future(self._collect_forever())
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "stored": self.stored,
+            "deduplicated": self.deduplicated,
+            "collected": self.collected,
+            "reclaimed": self.reclaimed,
+        }
+
+
+attachment_store: AttachmentStore = AttachmentStore(
+    ATTACHMENTS_FOLDER, ATTACHMENT_CONCURRENCY, ATTACHMENT_GC_DELAY, ATTACHMENT_GC_GRACE
+)
+
+
+def is_attachment_unchanged(
+    attachment: discord.Attachment,
+    filename: str,
+    previous: Optional[list[discord.Attachment]] = None,
+) -> bool:
+    if previous is not None and not any(
+        old.id == attachment.id and old.size == attachment.size for old in previous
+    ):
+        return False
+    return os.path.exists(filename) and os.path.getsize(filename) == attachment.size
+
+
+async def ingest_attachments(
+    message: discord.Message,
+    previous: Optional[list[discord.Attachment]] = None,
+    diff: bool = False,
+) -> list[tuple]:
+    existing = {}
+    if diff:
+        async with db.connection() as conn:
+            for row in await storage.get_attachments(conn, message.id):
+                if row[7] is not None:
+                    existing[row[7]] = row
+                else:
+                    existing[row[6] or os.path.basename(row[0]).split("_", 1)[-1]] = row
+
+    async def ingest(attachment: discord.Attachment) -> tuple:
+        row = existing.get(attachment.id) or existing.get(attachment.filename)
+        if row is not None and is_attachment_unchanged(attachment, row[0], previous):
+            return (message.id, *row[:6], attachment.filename, attachment.id)
+        async with attachment_store.slots:
+            filename, digest, info = await attachment_store.ingest(
+                attachment.url, attachment.filename
+            )
+        return (
+            message.id,
+            filename,
+            get_file_type(filename),
+            *info,
+            digest,
+            attachment.filename,
+            attachment.id,
+        )
+
+    results = await asyncio.gather(
+        *(ingest(attachment) for attachment in message.attachments),
+        return_exceptions=True,
+    )
+    errors = [result for result in results if isinstance(result, BaseException)]
+    if errors:
+        stored = [
+            result
+            for result in results
+            if not isinstance(result, BaseException) and result[6] is not None
+        ]
+        if stored:
+            await journal.append(storage.add_orphan_blobs(stored))
+            attachment_store.release()
+        raise errors[0]
+    return results
 
 
 def get_file_type(path: str) -> str:
@@ -212,7 +2510,7 @@ def get_file_type(path: str) -> str:
 
 async def get_user_display_name(user: Union[discord.User, discord.Member]) -> str:
     guild = client.get_guild(GUILD_ID)
-    member = guild.get_member(user.id)
+    member = guild.get_member(user.id) or user
     if member.name != member.display_name:
         return member.display_name
     else:
@@ -228,53 +2526,764 @@ async def update_user_roles(
     guild = client.get_guild(GUILD_ID)
 
     if auto == False:
-        new_role = discord.utils.get(user.roles, name=f"electrogram niveau {streak}")
+        new_role = level_roles.get(streak)
         if new_role is None:
-            new_role = discord.utils.get(
-                guild.roles, name=f"electrogram niveau {streak}"
-            )
-            if new_role is None:
-                icon_path = await create_role_icon(streak)
-                icon_bytes = await image_to_bytes(icon_path)
-                new_role = await guild.create_role(
+            icon_bytes = await role_icons.get(streak)
+            new_role = await outbound.call(
+                guild.create_role(
                     name=f"electrogram niveau {streak}", display_icon=icon_bytes
                 )
-        for role in user.roles:
-            if role.name.startswith("electrogram niveau"):
-                await user.remove_roles(role)
-                if len(role.members) == 0:
-                    await role.delete()
-        await user.add_roles(new_role)
+            )
+            level_roles.add(new_role)
+        await set_level_role(user, new_role)
+        role_icons.prerender([streak + 1])
     else:
         if days_difference >= 2:
-            for role in user.roles:
-                if role.name.startswith("electrogram niveau"):
-                    await user.remove_roles(role)
-                    if len(role.members) == 0:
-                        await role.delete()
+            await set_level_role(user, None)
+
+
+async def set_level_role(
+    user: discord.Member, new_role: Optional[discord.Role]
+) -> None:
+    removed = [
+        role
+        for role in user.roles
+        if role.name.startswith("electrogram niveau") and role != new_role
+    ]
+    if not removed and (new_role is None or new_role in user.roles):
+        return
+    roles = [
+        role for role in user.roles if not role.is_default() and role not in removed
+    ]
+    if new_role is not None and new_role not in roles:
+        roles.append(new_role)
+    await outbound.call(user.edit(roles=roles))
+    for role in removed:
+        if all(member.id == user.id for member in role.members):
+            await outbound.call(role.delete())
+
+
+class ProfileCache:
+    def __init__(self) -> None:
+        self.profiles: dict[int, tuple[str, str, Optional[str]]] = {}
+        self.complete = False
+        self.downloads: dict[int, tuple[str, asyncio.Task]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.downloaded = 0
+        self.deduplicated = 0
+
+    def load(self, rows: list[tuple]) -> None:
+        self.profiles = {row[0]: tuple(row[1:4]) for row in rows}
+        self.complete = True
+
+    async def fetch_avatar(self, user: Union[discord.User, discord.Member]) -> bool:
+        avatar_hash = user.display_avatar.key
+        download = self.downloads.get(user.id)
+        if download is not None and download[0] == avatar_hash:
+            self.deduplicated += 1
+            return await asyncio.shield(download[1])
+        task = asyncio.ensure_future(download_avatar(user))
+        self.downloads[user.id] = (avatar_hash, task)
+        try:
+            return await asyncio.shield(task)
+        finally:
+            if self.downloads.get(user.id, (None, None))[1] is task:
+                del self.downloads[user.id]
+            if task.done() and not task.cancelled() and task.result():
+                self.downloaded += 1
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "profiles": len(self.profiles),
+            "hits": self.hits,
+            "misses": self.misses,
+            "avatars_downloaded": self.downloaded,
+            "avatars_deduplicated": self.deduplicated,
+        }
+
+
+profile_cache: ProfileCache = ProfileCache()
+
+
+class StreakCache:
+    def __init__(self) -> None:
+        self.streaks: dict[int, tuple[int, Optional[int], datetime.date]] = {}
+        self.complete = False
+
+    def load(self, rows: list[tuple]) -> None:
+        self.streaks = {row[0]: tuple(row[1:4]) for row in rows}
+        self.complete = True
+
+    async def get(
+        self, user_id: int
+    ) -> Optional[tuple[int, Optional[int], datetime.date]]:
+        if user_id not in self.streaks and not self.complete:
+            async with db.connection() as conn:
+                result = await storage.get_streak(conn, user_id)
+            if result is not None:
+                self.streaks[user_id] = result
+        return self.streaks.get(user_id)
+
+
+streak_cache: StreakCache = StreakCache()
+
+
+class PayloadAttachment:
+    def __init__(self, data: dict[str, Any]) -> None:
+        self.id = int(data["id"])
+        self.filename: str = data["filename"]
+        self.size: int = data["size"]
+        self.url: str = data["url"]
+
+
+class PayloadReaction:
+    def __init__(self, data: dict[str, Any]) -> None:
+        self.emoji = discord.PartialEmoji.from_dict(data["emoji"])
+        self.count: int = data["count"]
+        self.me: bool = data["me"]
+
+
+class PayloadMessage:
+    def __init__(
+        self,
+        message: discord.PartialMessage,
+        data: dict[str, Any],
+        author: Union[discord.User, discord.Member],
+    ) -> None:
+        self.id = message.id
+        self.content: str = data["content"]
+        self.author = author
+        self.attachments = [PayloadAttachment(item) for item in data["attachments"]]
+        self.reactions = (
+            [PayloadReaction(item) for item in data["reactions"]]
+            if "reactions" in data
+            else None
+        )
+        self.delete = message.delete
+        self.add_reaction = message.add_reaction
+        self.remove_reaction = message.remove_reaction
+
+
+class ReactionIndex:
+    def __init__(self, size: int) -> None:
+        self.size = size
+        self.messages: collections.OrderedDict[
+            int, dict[str, Optional[int]]
+        ] = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+    def set(self, message_id: int, counts: dict[str, Optional[int]]) -> None:
+        self.messages[message_id] = counts
+        self.messages.move_to_end(message_id)
+        while len(self.messages) > self.size:
+            self.messages.popitem(last=False)
+            self.evicted += 1
+
+    def load(self, rows: list[tuple]) -> None:
+        self.messages.clear()
+        for message_id, emoji in sorted(rows, key=lambda row: row[0]):
+            counts = self.messages.setdefault(message_id, {})
+            if emoji is not None:
+                counts[emoji] = None
+
+    def seed(self, message: Union[discord.Message, PayloadMessage]) -> None:
+        self.set(
+            message.id,
+            {str(reaction.emoji): reaction.count for reaction in message.reactions},
+        )
+
+    def add(self, message_id: int, emoji: str) -> None:
+        counts = self.messages.get(message_id)
+        if counts is not None:
+            self.messages.move_to_end(message_id)
+            count = counts.get(emoji)
+            counts[emoji] = count + 1 if count is not None else None
+
+    async def remove(
+        self, channel: discord.TextChannel, message_id: int, emoji: str
+    ) -> int:
+        counts = self.messages.get(message_id)
+        if counts is not None and counts.get(emoji) is not None:
+            self.hits += 1
+            self.messages.move_to_end(message_id)
+            count = max(counts.pop(emoji) - 1, 0)
+            if count > 0:
+                counts[emoji] = count
+            return count
+        self.misses += 1
+        message = await outbound.call(channel.fetch_message(message_id))
+        self.seed(message)
+        return self.messages[message_id].get(emoji, 0)
+
+    def clear(self, message_id: int, emoji: Optional[str] = None) -> None:
+        counts = self.messages.get(message_id)
+        if counts is not None:
+            if emoji is None:
+                counts.clear()
+            else:
+                counts.pop(emoji, None)
+
+    def forget(self, message_id: int) -> None:
+        self.messages.pop(message_id, None)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "messages": len(self.messages),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evicted": self.evicted,
+        }
+
+
+reaction_index: ReactionIndex = ReactionIndex(REACTION_INDEX_SIZE)
+
+
+class EventDeduplicator:
+    def __init__(self, size: int, timeout: float) -> None:
+        self.size = size
+        self.timeout = timeout
+        self.events: collections.OrderedDict[
+            tuple[str, Hashable], Hashable
+        ] = collections.OrderedDict()
+        self.duplicates: dict[str, int] = collections.defaultdict(int)
+        self.database_hits = 0
+        self.timeouts = 0
+        self.evicted = 0
+
+    def _duplicate(self, event: str) -> None:
+        self.duplicates[event] += 1
+        metrics.count("duplicate_events", event=event)
+
+    def seen(self, event: str, key: Hashable, state: Hashable = None) -> bool:
+        entry = (event, key)
+        if entry in self.events and self.events[entry] == state:
+            self.events.move_to_end(entry)
+            self._duplicate(event)
+            return True
+        self.events[entry] = state
+        self.events.move_to_end(entry)
+        while len(self.events) > self.size:
+            self.events.popitem(last=False)
+            self.evicted += 1
+        return False
+
+    async def _message_exists(self, message_id: int) -> bool:
+        async with db.connection() as conn:
+            return await storage.message_exists(conn, message_id)
+
+    async def seen_message(self, message_id: int) -> bool:
+        if self.seen("message", message_id):
+            return True
+        if journal.failing:
+            return False
+        lookup = asyncio.ensure_future(self._message_exists(message_id))
+        lookup.add_done_callback(lambda task: task.cancelled() or task.exception())
+        try:
+            exists = await asyncio.wait_for(asyncio.shield(lookup), self.timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            return False
+        except Exception as e:
+            report_error("seen_message", e)
+            return False
+        if exists:
+            self.database_hits += 1
+            self._duplicate("message")
+        return exists
+
+    def forget(self, event: str, match: Callable[[Hashable], bool]) -> None:
+        for entry in [entry for entry in self.events if entry[0] == event]:
+            if match(entry[1]):
+                del self.events[entry]
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "events": len(self.events),
+            "duplicates": sum(self.duplicates.values()),
+            "database_hits": self.database_hits,
+            "timeouts": self.timeouts,
+            "evicted": self.evicted,
+        }
+
+
+event_deduplicator: EventDeduplicator = EventDeduplicator(
+    EVENT_DEDUPE_SIZE, EVENT_DEDUPE_TIMEOUT
+)
+
+
+class EmojiCache:
+    def __init__(self, folder: str) -> None:
+        self.folder = folder
+        self.downloads: dict[int, asyncio.Task] = {}
+        self.hits = 0
+        self.downloaded = 0
+        self.deduplicated = 0
+        self.refreshed = 0
+
+    def filename(self, emoji_id: int) -> str:
+        return f"{self.folder}/{emoji_id}.png"
+
+    async def fetch(
+        self, emoji: Union[discord.Emoji, discord.PartialEmoji], refresh: bool = False
+    ) -> str:
+        filename = self.filename(emoji.id)
+        download = self.downloads.get(emoji.id)
+        if download is not None:
+            self.deduplicated += 1
+            await asyncio.shield(download)
+            return filename
+        if not refresh and os.path.exists(filename):
+            self.hits += 1
+            return filename
+        task = asyncio.ensure_future(downloader.fetch(str(emoji.url), filename))
+        self.downloads[emoji.id] = task
+        try:
+            await asyncio.shield(task)
+            self.downloaded += 1
+        finally:
+            if self.downloads.get(emoji.id) is task:
+                del self.downloads[emoji.id]
+        return filename
+
+    async def refresh(
+        self, before: tuple[discord.Emoji, ...], after: tuple[discord.Emoji, ...]
+    ) -> None:
+        previous = {emoji.id: emoji for emoji in before}
+        changed = [
+            emoji
+            for emoji in after
+            if emoji.id in previous
+            and (emoji.animated, emoji.name) != (
+                previous[emoji.id].animated,
+                previous[emoji.id].name,
+            )
+            and os.path.exists(self.filename(emoji.id))
+        ]
+        results = await asyncio.gather(
+            *(self.fetch(emoji, True) for emoji in changed), return_exceptions=True
+        )
+        for result in results:
+            if isinstance(result, BaseException):
+                print("Error in EmojiCache.refresh:", result)
+            else:
+                self.refreshed += 1
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "hits": self.hits,
+            "downloaded": self.downloaded,
+            "deduplicated": self.deduplicated,
+            "refreshed": self.refreshed,
+        }
+
+
+emoji_cache: EmojiCache = EmojiCache(CUSTOM_EMOJIS_FOLDER)
 
 
 async def update_user_profile(
-    cursor: mysql.connector.cursor.MySQLCursor,
     user: Union[discord.User, discord.Member],
     create_if_not_exist: Optional[bool] = False,
-) -> None:
-    cursor.execute("SELECT * FROM users WHERE id = %s", (user.id,))
-    result = cursor.fetchone()
-    if result is not None or create_if_not_exist is True:
-        avatar = f"{AVATARS_FOLDER}/{user.id}.png"
-        if result is None:
-            cursor.execute(
-                "INSERT INTO users (id, username, display_name, avatar) VALUES (%s, %s, %s, %s)",
-                (user.id, user.name, await get_user_display_name(user), avatar),
-            )
+) -> list[Statement]:
+    profile = (user.name, await get_user_display_name(user), user.display_avatar.key)
+    known = profile_cache.profiles.get(user.id)
+    if known is None and not profile_cache.complete:
+        try:
+            async with db.connection() as conn:
+                result = await storage.get_user(conn, user.id)
+        except Exception as e:
+            report_error("update_user_profile", e)
+            result = None
+        if result is not None:
+            known = profile_cache.profiles[user.id] = result
+    avatar = f"{AVATARS_FOLDER}/{user.id}.png"
+    if known == profile and os.path.exists(avatar):
+        profile_cache.hits += 1
+        if create_if_not_exist is True:
+            return storage.save_user(user.id, *profile[:2], avatar, profile[2])
+        return []
+    if known is None and create_if_not_exist is not True:
+        return []
+
+    profile_cache.misses += 1
+    profile_cache.profiles[user.id] = profile
+    try:
+        avatar_hash = profile[2]
+        if known is None or known[2] != avatar_hash or not os.path.exists(avatar):
+            if not await profile_cache.fetch_avatar(user):
+                avatar_hash = None
+                profile_cache.profiles[user.id] = (*profile[:2], None)
+        if create_if_not_exist is True:
+            return storage.save_user(user.id, *profile[:2], avatar, avatar_hash)
+        if known != (*profile[:2], avatar_hash):
+            return storage.update_user(user.id, *profile[:2], avatar, avatar_hash)
+        return []
+    except BaseException:
+        if known is None:
+            profile_cache.profiles.pop(user.id, None)
         else:
-            cursor.execute(
-                "UPDATE users SET avatar = %s, username = %s, display_name = %s WHERE id = %s",
-                (avatar, user.name, await get_user_display_name(user), user.id),
-            )
-        avatar_url = str(user.display_avatar.url)
+            profile_cache.profiles[user.id] = known
+        raise
+
+
+async def download_avatar(user: Union[discord.User, discord.Member]) -> bool:
+    avatar = f"{AVATARS_FOLDER}/{user.id}.png"
+    avatar_url = str(user.display_avatar.url)
+    try:
         await download_file(avatar_url, avatar)
+        return True
+    except DownloadError as e:
+        print("Error in download_avatar:", e)
+        return False
+
+
+async def reconcile_members(guild: discord.Guild) -> None:
+    global streak_expiry_cutoff
+    started = monotonic()
+    async with db.connection() as conn:
+        profile_cache.load(await storage.get_users(conn))
+        streak_cache.load(await storage.get_streaks(conn))
+        reaction_index.load(await storage.get_recent_tags(conn, REACTION_INDEX_SIZE))
+        streaks = {}
+        levels = set(range(1, LEVEL_ICON_PRERENDER + 1))
+        for user_id, (streak, _, last_message_date) in streak_cache.streaks.items():
+            streaks[user_id] = last_message_date
+            if streak is not None:
+                levels.add(streak + 1)
+    level_roles.load(guild)
+    role_icons.prerender(sorted(levels))
+    loaded = monotonic()
+
+    today = datetime.date.today()
+    profiles = []
+    expired = []
+    for member in guild.members:
+        known = profile_cache.profiles.get(member.id)
+        if known is not None:
+            profile = (
+                member.name,
+                await get_user_display_name(member),
+                member.display_avatar.key,
+            )
+            if known != profile or not os.path.exists(
+                f"{AVATARS_FOLDER}/{member.id}.png"
+            ):
+                profiles.append((member, profile, known))
+            else:
+                profile_cache.hits += 1
+        last_message_date = streaks.get(member.id)
+        if last_message_date is not None and (today - last_message_date).days >= 2:
+            expired.append(member.id)
+    compared = monotonic()
+
+    if profiles:
+        profile_cache.misses += len(profiles)
+        downloaded = await asyncio.gather(
+            *(
+                profile_cache.fetch_avatar(member)
+                if known[2] != profile[2]
+                or not os.path.exists(f"{AVATARS_FOLDER}/{member.id}.png")
+                else asyncio.sleep(0, True)
+                for member, profile, known in profiles
+            )
+        )
+        rows = []
+        for (member, profile, known), ok in zip(profiles, downloaded):
+            profile = (*profile[:2], profile[2] if ok else known[2])
+            profile_cache.profiles[member.id] = profile
+            rows.append((*profile, member.id))
+        await journal.append(storage.update_profiles(rows))
+    refreshed = monotonic()
+
+    updated, failed, _ = await expire_streak_roles(guild, expired)
+    if failed == 0:
+        streak_expiry_cutoff = today - datetime.timedelta(days=2)
+    finished = monotonic()
+
+    print(
+        f"Startup reconciliation of {len(guild.members)} members:",
+        f"loaded {len(profile_cache.profiles)} users and {len(streaks)} streaks",
+        f"in {loaded - started:.2f}s,",
+        f"compared in {compared - loaded:.2f}s,",
+        f"refreshed {len(profiles)} profiles in {refreshed - compared:.2f}s,",
+        f"removed expired roles of {updated} members in {finished - refreshed:.2f}s",
+    )
+
+
+def is_message_valid(message: discord.Message) -> bool:
+    return (
+        message.type in (discord.MessageType.default, discord.MessageType.reply)
+        and len(message.attachments) > 0
+        and message.content.strip() != ""
+        and all(
+            os.path.splitext(attachment.filename)[1] in ALLOWED_EXTENSIONS
+            for attachment in message.attachments
+        )
+    )
+
+
+async def get_backfill_statements(message: discord.Message) -> list[Statement]:
+    attachments = await ingest_attachments(message, None, True)
+    tags = []
+    for reaction in message.reactions:
+        if str(reaction.emoji) == str("❌"):
+            continue
+        tags.append((message.id, *get_tag(reaction.emoji)))
+        if isinstance(reaction.emoji, (discord.Emoji, discord.PartialEmoji)):
+            await emoji_cache.fetch(reaction.emoji)
+    return (
+        storage.save_message(
+            message.id,
+            render_content(message.content),
+            message.author.id,
+            message.created_at.strftime("%Y-%m-%d %H:%M:%S"),
+        )
+        + storage.replace_attachments(message.id, attachments)
+        + storage.replace_tags(message.id, tags)
+        + await update_user_profile(message.author, True)
+    )
+
+
+async def get_history_page(
+    channel: discord.TextChannel, after: int
+) -> list[discord.Message]:
+    return [
+        message
+        async for message in channel.history(
+            limit=BACKFILL_BATCH_SIZE, after=discord.Object(after), oldest_first=True
+        )
+    ]
+
+
+async def backfill_history(channel: discord.TextChannel, full: bool = False) -> None:
+    mode = "full" if full else "incremental"
+    started = monotonic()
+    horizon = discord.utils.time_snowflake(discord.utils.utcnow())
+    async with db.connection() as conn:
+        after = await storage.get_checkpoint(conn, channel.id, mode) or 0
+        if not full:
+            after = max(after, await storage.get_last_message_id(conn) or 0)
+    print(f"Backfill ({mode}) of #{channel.name} resuming after message {after}")
+
+    archived = skipped = deleted = 0
+
+    async def ingest(batch: list[discord.Message], last_message_id: int) -> None:
+        nonlocal archived, skipped, deleted, after
+        valid = [message for message in batch if is_message_valid(message)]
+        skipped += len(batch) - len(valid)
+        results = await asyncio.gather(
+            *(get_backfill_statements(message) for message in valid),
+            return_exceptions=True,
+        )
+        statements = []
+        for message, result in zip(valid, results):
+            if isinstance(result, BaseException):
+                raise result
+            statements += result
+            reaction_index.seed(message)
+
+        stale = []
+        if full:
+            async with db.connection() as conn:
+                archived_ids = await storage.get_message_ids(
+                    conn, after, last_message_id
+                )
+            kept = {message.id for message in valid}
+            stale = [
+                message_id for message_id in archived_ids if message_id not in kept
+            ]
+            if stale:
+                statements += storage.delete_messages(stale)
+
+        statements += storage.save_checkpoint(channel.id, mode, last_message_id)
+        await journal.append(statements)
+        for message_id in stale:
+            reaction_index.forget(message_id)
+        attachment_store.release(stale)
+        archived += len(valid)
+        deleted += len(stale)
+        after = last_message_id
+
+    while True:
+        batch = await outbound.call(get_history_page(channel, after))
+        if len(batch) < BACKFILL_BATCH_SIZE:
+            break
+        await ingest(batch, batch[-1].id)
+    await ingest(batch, horizon if full else max([after] + [m.id for m in batch]))
+
+    if full:
+        await journal.append(storage.delete_checkpoint(channel.id, mode))
+    await journal.drain()
+    if deleted:
+        await attachment_store.collect()
+    elapsed = monotonic() - started
+    print(
+        f"Backfill ({mode}) of #{channel.name}:",
+        f"archived {archived} messages, skipped {skipped}, deleted {deleted}",
+        f"in {elapsed:.2f}s ({archived / elapsed if elapsed else 0:.1f} messages/s)",
+    )
+
+
+async def compact_attachments(dry_run: bool = False) -> int:
+    started = monotonic()
+    if dry_run:
+        async with db.connection() as conn:
+            version = await get_schema_version(conn)
+        if version < MIGRATIONS[-1][0]:
+            print("Database not migrated; run the bot or `verify` first")
+            return 1
+    else:
+        await prepare_database()
+        await journal.drain()
+
+    adopted = missing = 0
+    async with db.connection() as conn:
+        legacy = await storage.get_legacy_attachments(conn)
+    references = collections.defaultdict(list)
+    for attachment_id, message_id, filename in legacy:
+        references[filename].append((attachment_id, message_id))
+    for filename, rows in references.items():
+        if not os.path.exists(filename):
+            print("Missing attachment file:", filename)
+            missing += len(rows)
+            continue
+        if dry_run:
+            adopted += len(rows)
+            continue
+        blob, digest, info = await attachment_store.adopt(filename)
+        statements = []
+        for attachment_id, message_id in rows:
+            name = os.path.basename(filename).removeprefix(f"{message_id}_")
+            statements += storage.adopt_attachment(
+                attachment_id, blob, digest, name, info
+            )
+        async with db.connection() as conn:
+            await conn.execute_all(statements)
+            await conn.commit()
+        adopted += len(rows)
+
+    collected = 0
+    if not dry_run:
+        async with db.connection() as conn:
+            await conn.execute_all(storage.recount_blobs())
+            await conn.commit()
+        collected = await attachment_store.collect(0)
+
+    async with db.connection() as conn:
+        known = {
+            os.path.abspath(filename)
+            for filename in await storage.get_attachment_filenames(conn)
+        } | {
+            os.path.abspath(filename)
+            for _, filename, _ in await storage.get_blobs(conn)
+        }
+    strays = []
+    for folder, _, filenames in os.walk(ATTACHMENTS_FOLDER):
+        for filename in filenames:
+            path = os.path.abspath(os.path.join(folder, filename))
+            if (
+                BLOB_NAME.fullmatch(os.path.relpath(path, ATTACHMENTS_FOLDER))
+                and path.removesuffix(".thumb.jpg") not in known
+            ):
+                strays.append(path)
+    if dry_run:
+        for path in strays:
+            print("Would remove", path)
+    else:
+        for path in strays:
+            with contextlib.suppress(FileNotFoundError):
+                attachment_store.reclaimed += os.path.getsize(path)
+                os.remove(path)
+    thumbnails.close()
+
+    print(
+        f"Attachment compaction{' (dry run)' if dry_run else ''}:",
+        f"adopted {adopted} legacy attachments ({missing} missing),",
+        f"collected {collected} orphan blobs, removed {len(strays)} stray files,",
+        f"reclaimed {attachment_store.reclaimed / 2**20:.1f} MiB",
+        f"in {monotonic() - started:.2f}s",
+    )
+    return 0
+
+
+async def verify_attachments() -> int:
+    started = monotonic()
+    async with db.connection() as conn:
+        await create_tables(conn)
+    await journal.drain()
+    async with db.connection() as conn:
+        blobs = await storage.get_blobs(conn)
+        references = await storage.get_blob_references(conn)
+        legacy = await storage.get_legacy_attachments(conn)
+
+    problems = 0
+    for digest, filename, refcount in blobs:
+        if not os.path.exists(filename):
+            print("Missing blob:", digest, filename)
+            problems += 1
+        elif await asyncio.to_thread(hash_file, filename) != digest:
+            print("Corrupted blob:", digest, filename)
+            problems += 1
+        elif get_media_kind(filename) is not None and not os.path.exists(
+            f"{filename}.thumb.jpg"
+        ):
+            print("Missing thumbnail:", digest, filename)
+            problems += 1
+        if refcount != references.get(digest, 0):
+            print(
+                "Wrong reference count:",
+                digest,
+                refcount,
+                "instead of",
+                references.get(digest, 0),
+            )
+            problems += 1
+    for digest in references.keys() - {digest for digest, _, _ in blobs}:
+        print("Attachments reference an unknown blob:", digest)
+        problems += 1
+    if legacy:
+        print(f"{len(legacy)} attachments still use the legacy layout, run compact")
+
+    print(
+        f"Attachment verification: {len(blobs)} blobs checked,",
+        f"{problems} problems in {monotonic() - started:.2f}s",
+    )
+    return 1 if problems else 0
+
+
+async def rebuild_user_stats() -> int:
+    started = monotonic()
+    async with db.connection() as conn:
+        await create_tables(conn)
+    await journal.drain()
+
+    async with db.connection() as conn:
+        before = await storage.get_all_user_stats(conn)
+        await conn.execute_all(storage.rebuild_user_stats())
+        await conn.commit()
+        after = await storage.get_all_user_stats(conn)
+    corrected = {row[0] for row in set(map(tuple, before)) ^ set(map(tuple, after))}
+    print(
+        f"User statistics rebuilt: {len(after)} users, {len(corrected)} corrected",
+        f"in {monotonic() - started:.2f}s",
+    )
+    return 0
+
+
+async def delete_archived_messages(message_ids: list[int]) -> None:
+    message_ids = [
+        message_id
+        for message_id in message_ids
+        if not event_deduplicator.seen("delete", message_id)
+    ]
+    if not message_ids:
+        return
+    for message_id in message_ids:
+        reaction_index.forget(message_id)
+    await journal.append(storage.delete_messages(message_ids))
+    attachment_store.release(message_ids)
 
 
 def get_streak_message(display_name: str, streak: int, state: str) -> discord.Embed:
@@ -336,48 +3345,73 @@ class OpenElectrogram(discord.ui.View):
 
 
 @client.event
+@metrics.handler
+async def on_connect() -> None:
+    startup.mark("gateway")
+
+
+@client.event
+@metrics.handler
 async def on_ready() -> None:
+    startup.mark("guild_sync")
+    if options.command != "backfill":
+        journal.start(prepare_database)
+        attachment_store.start()
+        if not streak_update.is_running():
+            streak_update.start()
     try:
-        mydb = mysql.connector.connect(**DB_CONFIG)
-        cursor = mydb.cursor()
-        create_tables(cursor)
-        mydb.close()
-        guild = client.get_guild(GUILD_ID)
-        for member in guild.members:
-            mydb = mysql.connector.connect(**DB_CONFIG)
-            cursor = mydb.cursor()
-            await update_user_profile(cursor, member)
-            cursor.execute(
-                "SELECT last_message_date FROM streaks WHERE user_id = %s", (member.id,)
-            )
-            result = cursor.fetchone()
-            if result is not None:
-                last_message_date = result[0]
-                mydb.commit()
-                mydb.close()
-                today = datetime.date.today()
-                days_difference = (today - last_message_date).days
-                await update_user_roles(member, days_difference, None, True)
-            else:
-                mydb.commit()
-                mydb.close()
-
-        streak_update.start()
+        await metrics.start(
+            METRICS_HOST,
+            METRICS_PORT,
+            {
+                "db": db.stats,
+                "journal": journal.stats,
+                "downloader": downloader.stats,
+                "thumbnails": thumbnails.stats,
+                "outbound": outbound.stats,
+                "profile_cache": profile_cache.stats,
+                "reaction_index": reaction_index.stats,
+                "event_deduplicator": event_deduplicator.stats,
+                "emoji_cache": emoji_cache.stats,
+                "attachment_store": attachment_store.stats,
+                "startup": startup.stats,
+            },
+        )
+        startup.mark("metrics")
+        if options.command == "backfill":
+            await prepare_database()
+        else:
+            await journal.prepared.wait()
+        startup.mark("schema")
+        await journal.drain()
+        startup.mark("journal")
+        await reconcile_members(client.get_guild(GUILD_ID))
+        startup.finish("reconcile")
+
+        if options.command == "backfill":
+            try:
+                await backfill_history(client.get_channel(CHANNEL_ID), options.full)
+            finally:
+                await client.close()
+            return
     except Exception as e:
-        print("Error in on_ready:", e)
+        report_error("on_ready", e)
 
 
 @client.event
+@metrics.handler
 async def on_message(message: discord.Message) -> None:
     try:
         if message.channel.id == CHANNEL_ID:
-            mydb = mysql.connector.connect(**DB_CONFIG)
-            cursor = mydb.cursor()
+            if await event_deduplicator.seen_message(message.id):
+                return
 
             if len(message.attachments) == 0 or message.content.strip() == "":
-                await message.delete()
-                await message.author.send(
-                    "Coucou ! :wave:\nVotre publication a été malheureusement refusée... :sob:\nPour être publiée sur electrogram, elle doit contenir du texte ainsi qu’une ou plusieurs images et/ou vidéos.\nRéessayez, je reste à votre service. :wink:"
+                await outbound.call(message.delete())
+                await outbound.call(
+                    message.author.send(
+                        "Coucou ! :wave:\nVotre publication a été malheureusement refusée... :sob:\nPour être publiée sur electrogram, elle doit contenir du texte ainsi qu’une ou plusieurs images et/ou vidéos.\nRéessayez, je reste à votre service. :wink:"
+                    )
                 )
                 return
 
@@ -385,88 +3419,71 @@ async def on_message(message: discord.Message) -> None:
                 os.path.splitext(attachment.filename)[1] in ALLOWED_EXTENSIONS
                 for attachment in message.attachments
             ):
-                await message.delete()
-                await message.author.send(
-                    "Coucou ! :wave:\nVotre publication a été malheureusement refusée... :sob:\nVous avez envoyé un fichier qui n’est pas une image ou une vidéo.\nRéessayez, je reste à votre service. :wink:"
+                await outbound.call(message.delete())
+                await outbound.call(
+                    message.author.send(
+                        "Coucou ! :wave:\nVotre publication a été malheureusement refusée... :sob:\nVous avez envoyé un fichier qui n’est pas une image ou une vidéo.\nRéessayez, je reste à votre service. :wink:"
+                    )
                 )
                 return
 
+            reaction_index.seed(message)
+            started = monotonic()
+            calls = outbound.track()
             timestamp = message.created_at.strftime("%Y-%m-%d %H:%M:%S")
+            attachments = await ingest_attachments(message)
 
-            sql = "INSERT INTO messages (id, content, user_id, timestamp) VALUES (%s, %s, %s, %s)"
-            val = (
+            statements = storage.add_message(
                 message.id,
-                markdown.markdown(detect_link(message.content)),
+                render_content(message.content),
                 message.author.id,
                 timestamp,
-            )
-            cursor.execute(sql, val)
-
-            for attachment in message.attachments:
-                attachment_name = (
-                    f"{ATTACHMENTS_FOLDER}/{message.id}_{attachment.filename}"
-                )
-                await download_file(attachment.url, attachment_name)
-                sql = "INSERT INTO attachments (message_id, filename, type) VALUES (%s, %s, %s)"
-                val = (message.id, attachment_name, get_file_type(attachment_name))
-                cursor.execute(sql, val)
-
+            ) + storage.replace_attachments(message.id, attachments)
             try:
-                mydb.commit()
-                cursor.execute(
-                    "SELECT streak, max_streak, last_message_date FROM streaks WHERE user_id = %s",
-                    (message.author.id,),
-                )
-                result = cursor.fetchone()
+                result = await streak_cache.get(message.author.id)
+                streak_known = True
+            except Exception as e:
+                report_error("on_message", e)
+                result, streak_known = None, False
 
-                today = datetime.date.today()
+            today = datetime.date.today()
 
-                display_name = await get_user_display_name(message.author)
+            display_name = await get_user_display_name(message.author)
 
-                if result is None:
-                    streak = 1
-                    cursor.execute(
-                        "INSERT INTO streaks (user_id, streak, max_streak, last_message_date) VALUES (%s, %s, %s, %s)",
-                        (message.author.id, streak, streak, today),
-                    )
-                    streak_message = get_streak_message(display_name, streak, "new")
-                    last_message_date = today
+            if not streak_known:
+                streak_message = None
+            elif result is None:
+                streak = max_streak = 1
+                streak_message = get_streak_message(display_name, streak, "new")
+                last_message_date = today
+            else:
+                streak, max_streak, last_message_date = result
+                if last_message_date == today - datetime.timedelta(days=1):
+                    streak += 1
+                    if max_streak is None or max_streak < streak:
+                        max_streak = streak
+                    streak_message = get_streak_message(display_name, streak, "ok")
+                elif last_message_date == today:
+                    streak_message = get_streak_message(display_name, streak, "again")
                 else:
-                    streak, max_streak, last_message_date = result
-                    if last_message_date == today - datetime.timedelta(days=1):
-                        streak += 1
-                        if max_streak is None or max_streak < streak:
-                            max_streak = streak
-                        cursor.execute(
-                            "UPDATE streaks SET streak = %s, max_streak = %s, last_message_date = %s WHERE user_id = %s",
-                            (streak, max_streak, today, message.author.id),
-                        )
-                        streak_message = get_streak_message(display_name, streak, "ok")
-                    elif last_message_date == today:
-                        streak_message = get_streak_message(
-                            display_name, streak, "again"
-                        )
-                    else:
-                        streak = 1
-                        cursor.execute(
-                            "UPDATE streaks SET streak = %s, last_message_date = %s WHERE user_id = %s",
-                            (streak, today, message.author.id),
-                        )
-                        streak_message = get_streak_message(
-                            display_name, streak, "reset"
-                        )
-                await update_user_profile(cursor, message.author, True)
-                days_difference = (today - last_message_date).days
-                thread = await message.create_thread(
-                    name=f"Nouvelle publication dans l’electrogram de {display_name}"
-                )
-                streak_message.set_author(
-                    name=f"{display_name}", icon_url=message.author.avatar
+                    streak = 1
+                    streak_message = get_streak_message(display_name, streak, "reset")
+            if streak_known and (result is None or last_message_date != today):
+                statements += storage.save_streak(
+                    message.author.id, streak, max_streak, today
                 )
-                await thread.send(
-                    view=OpenElectrogram(message.author.name, display_name)
+            statements += await update_user_profile(message.author, True)
+            await journal.append(statements)
+            if streak_known:
+                streak_cache.streaks[message.author.id] = (streak, max_streak, today)
+                days_difference = (today - last_message_date).days
+
+            try:
+                thread = await outbound.call(
+                    message.create_thread(
+                        name=f"Nouvelle publication dans l’electrogram de {display_name}"
+                    )
                 )
-                await thread.send(embed=streak_message)
                 embed = discord.Embed(
                     title=f"Discutez de cette publication avec {display_name} !",
                     color=0x1E1F1D,
@@ -477,359 +3494,388 @@ async def on_message(message: discord.Message) -> None:
                     inline=False,
                 )
                 embed.set_author(name=f"{display_name}", icon_url=message.author.avatar)
-                await thread.send(embed=embed)
-                added_reactions = set()
-                for pattern, reaction in reactions.items():
-                    if (
-                        re.search(
-                            rf"\b{re.escape(pattern)}\b",
-                            remove_accents(message.content.lower()),
+                embeds = [embed]
+                if streak_message is not None:
+                    streak_message.set_author(
+                        name=f"{display_name}", icon_url=message.author.avatar
+                    )
+                    embeds.insert(0, streak_message)
+                await asyncio.gather(
+                    outbound.call(
+                        thread.send(
+                            view=OpenElectrogram(message.author.name, display_name),
+                            embeds=embeds,
                         )
-                        and reaction not in added_reactions
-                    ):
-                        if reaction.startswith("<:") and reaction.endswith(">"):
-                            emoji_id = int(reaction.split(":")[-1][:-1])
-                            emoji = discord.utils.get(client.emojis, id=emoji_id)
-                            if emoji:
-                                await message.add_reaction(emoji)
-                                added_reactions.add(str(emoji))
-                        else:
-                            await message.add_reaction(reaction)
-                            added_reactions.add(reaction)
+                    ),
+                    add_message_reactions(
+                        message, get_message_reactions(message.content)
+                    ),
+                )
             except Exception as e:
-                print("Error in on_message:", e)
+                report_error("on_message", e)
 
-            finally:
-                try:
-                    mydb.commit()
-                except:
-                    print("Error in on_message:", e)
-                    await message.add_reaction("❌")
-                    await message.delete()
-                    await message.author.send(
-                        "Coucou ! :wave:\nUne erreur est survenue... :sob:\nNous faisons tout notre possible pour résoudre ce problème\nRetentez dans quelques minutes."
-                    )
-                mydb.close()
-                if result is None or days_difference != 0:
-                    await update_user_roles(message.author, days_difference, streak)
+            if streak_known and (result is None or days_difference != 0):
+                await update_user_roles(message.author, days_difference, streak)
+            outbound.record(started, calls)
     except Exception as e:
-        print("Error in on_message:", e)
-        await message.add_reaction("❌")
-        await message.delete()
-        await message.author.send(
-            "Coucou ! :wave:\nUne erreur est survenue... :sob:\nNous faisons tout notre possible pour résoudre ce problème\nRetentez dans quelques minutes."
+        report_error("on_message", e)
+        await outbound.call(message.add_reaction("❌"))
+        await outbound.call(message.delete())
+        await outbound.call(
+            message.author.send(
+                "Coucou ! :wave:\nUne erreur est survenue... :sob:\nNous faisons tout notre possible pour résoudre ce problème\nRetentez dans quelques minutes."
+            )
         )
 
 
 @client.event
+@metrics.handler
 async def on_raw_message_edit(payload: discord.RawMessageUpdateEvent) -> None:
     try:
-        channel = await client.fetch_channel(payload.channel_id)
-        if channel.id == CHANNEL_ID:
-            message = await channel.fetch_message(payload.message_id)
-            mydb = mysql.connector.connect(**DB_CONFIG)
-            cursor = mydb.cursor()
+        if payload.channel_id != CHANNEL_ID:
+            return
+        data = payload.data
+        if "content" not in data and "attachments" not in data:
+            return
+        edited_at = data.get("edited_timestamp")
+        if edited_at is not None and event_deduplicator.seen(
+            "edit", payload.message_id, edited_at
+        ):
+            return
 
-            if len(message.attachments) == 0 or message.content.strip() == "":
-                await message.delete()
-                await message.author.send(
+        channel = client.get_channel(
+            payload.channel_id
+        ) or await outbound.call(client.fetch_channel(payload.channel_id))
+        if {"author", "content", "attachments"} <= data.keys():
+            author_id = int(data["author"]["id"])
+            author = channel.guild.get_member(author_id) or await outbound.call(
+                client.fetch_user(author_id)
+            )
+            message = PayloadMessage(
+                channel.get_partial_message(payload.message_id), data, author
+            )
+        else:
+            message = await outbound.call(channel.fetch_message(payload.message_id))
+        old_message = payload.cached_message
+        if message.reactions is not None:
+            reaction_index.seed(message)
+
+        if len(message.attachments) == 0 or message.content.strip() == "":
+            await outbound.call(message.delete())
+            await outbound.call(
+                message.author.send(
                     "Coucou ! :wave:\nVotre publication a été malheureusement refusée... :sob:\nPour être publiée sur electrogram, elle doit contenir du texte ainsi qu’une ou plusieurs images et/ou vidéos.\nRéessayez, je reste à votre service. :wink:"
                 )
-                return
+            )
+            return
 
-            if not all(
-                os.path.splitext(attachment.filename)[1] in ALLOWED_EXTENSIONS
-                for attachment in message.attachments
-            ):
-                await message.delete()
-                await message.author.send(
+        if not all(
+            os.path.splitext(attachment.filename)[1] in ALLOWED_EXTENSIONS
+            for attachment in message.attachments
+        ):
+            await outbound.call(message.delete())
+            await outbound.call(
+                message.author.send(
                     "Coucou ! :wave:\nVotre publication a été malheureusement refusée... :sob:\nVous avez envoyé un fichier qui n’est pas une image ou une vidéo.\nRéessayez, je reste à votre service. :wink:"
                 )
-                return
+            )
+            return
 
-            for filename in glob.glob(f"{ATTACHMENTS_FOLDER}/{message.id}_*"):
-                os.remove(filename)
-            cursor.execute(
-                "DELETE FROM attachments WHERE message_id = %s",
-                (message.id,),
+        previous = old_message.attachments if old_message is not None else None
+        content_changed = old_message is None or old_message.content != message.content
+        attachments = await ingest_attachments(message, previous, True)
+
+        statements = storage.replace_attachments(message.id, attachments)
+        if content_changed:
+            statements += storage.update_message_content(
+                message.id, render_content(message.content)
             )
+        await journal.append(statements)
+        await asyncio.to_thread(
+            remove_message_files,
+            [message.id],
+            {attachment[1] for attachment in attachments},
+        )
+        attachment_store.release()
 
-            for attachment in message.attachments:
-                attachment_name = (
-                    f"{ATTACHMENTS_FOLDER}/{message.id}_{attachment.filename}"
-                )
-                await download_file(attachment.url, attachment_name)
-                sql = "INSERT INTO attachments (message_id, filename, type) VALUES (%s, %s, %s)"
-                val = (message.id, attachment_name, get_file_type(attachment_name))
-                cursor.execute(sql, val)
-
-            sql = "UPDATE messages SET content = %s WHERE id = %s"
-            val = (markdown.markdown(detect_link(message.content)), message.id)
-            cursor.execute(sql, val)
-            mydb.commit()
-
-            for reaction in message.reactions:
-                if reaction.me:
-                    users = [user async for user in reaction.users()]
-                    for user in users:
-                        if user == client.user:
-                            if isinstance(
-                                reaction.emoji, (discord.Emoji, discord.PartialEmoji)
-                            ):
-                                emoji = str(reaction.emoji)
-                            else:
-                                emoji = reaction.emoji
-                            for pattern, reaction_pattern in reactions.items():
-                                if re.search(
-                                    rf"\b{re.escape(pattern)}\b",
-                                    remove_accents(message.content.lower()),
-                                ):
-                                    if str(emoji) == str("❌"):
-                                        break
-                                    if reaction_pattern == emoji:
-                                        break
-                            else:
-                                await message.remove_reaction(
-                                    reaction.emoji, client.user
-                                )
-
-            added_reactions = set()
-            for pattern, reaction in reactions.items():
-                if (
-                    re.search(rf"\b{re.escape(pattern)}\b", remove_accents(message.content.lower()))
-                    and reaction not in added_reactions
-                ):
-                    if reaction.startswith("<:") and reaction.endswith(">"):
-                        emoji_id = int(reaction.split(":")[-1][:-1])
-                        emoji = discord.utils.get(client.emojis, id=emoji_id)
-                        if emoji:
-                            await message.add_reaction(emoji)
-                            added_reactions.add(str(emoji))
-                    else:
-                        await message.add_reaction(reaction)
-                        added_reactions.add(reaction)
-
-            mydb.close()
+        if not content_changed:
+            return
+
+        matched = get_message_reactions(message.content)
+        wanted = {reaction for reaction, _ in matched}
+        if message.reactions is None:
+            fetched = await outbound.call(channel.fetch_message(payload.message_id))
+            reaction_index.seed(fetched)
+            message.reactions = fetched.reactions
+        for reaction in message.reactions:
+            if reaction.me:
+                if isinstance(reaction.emoji, (discord.Emoji, discord.PartialEmoji)):
+                    emoji = str(reaction.emoji)
+                else:
+                    emoji = reaction.emoji
+                if emoji not in wanted and not (str(emoji) == str("❌") and matched):
+                    await outbound.call(
+                        message.remove_reaction(reaction.emoji, client.user)
+                    )
+
+        await add_message_reactions(message, matched)
     except Exception as e:
-        print("Error in on_raw_message_edit:", e)
+        report_error("on_raw_message_edit", e)
 
 
 @client.event
+@metrics.handler
 async def on_raw_message_delete(payload: discord.RawMessageDeleteEvent) -> None:
     try:
         message_id = payload.message_id
         channel_id = payload.channel_id
 
         if channel_id == CHANNEL_ID:
-            mydb = mysql.connector.connect(**DB_CONFIG)
-            cursor = mydb.cursor()
-
-            cursor.execute("SELECT user_id FROM messages WHERE id = %s", (message_id,))
-            result = cursor.fetchone()
-            if result is None:
-                return
-            user_id = result[0]
-
-            cursor.execute(
-                "SELECT COUNT(*) FROM messages WHERE user_id = %s", (user_id,)
-            )
-            count = cursor.fetchone()[0]
-            if count == 1:
-                cursor.execute("DELETE FROM users WHERE id = %s", (user_id,))
+            await delete_archived_messages([message_id])
+    except Exception as e:
+        report_error("on_raw_message_delete", e)
 
-            cursor.execute(
-                "SELECT filename FROM attachments WHERE message_id = %s", (message_id,)
-            )
-            result = cursor.fetchall()
-            for row in result:
-                if os.path.exists(row[0]):
-                    os.remove(row[0])
-                    os.remove(row[0] + ".thumb.jpg")
 
-            cursor.execute("DELETE FROM messages WHERE id = %s", (message_id,))
-            cursor.execute(
-                "DELETE FROM attachments WHERE message_id = %s", (message_id,)
-            )
-            cursor.execute("DELETE FROM tags WHERE message_id = %s", (message_id,))
-            mydb.commit()
-            mydb.close()
+@client.event
+@metrics.handler
+async def on_raw_bulk_message_delete(
+    payload: discord.RawBulkMessageDeleteEvent,
+) -> None:
+    try:
+        if payload.channel_id == CHANNEL_ID:
+            await delete_archived_messages(sorted(payload.message_ids))
     except Exception as e:
-        print("Error in on_raw_message_delete:", e)
+        report_error("on_raw_bulk_message_delete", e)
 
 
 @client.event
+@metrics.handler
 async def on_raw_reaction_add(payload: discord.RawReactionActionEvent) -> None:
     try:
         if str(payload.emoji) == str("❌"):
             return
-        mydb = mysql.connector.connect(**DB_CONFIG)
-        cursor = mydb.cursor()
         if payload.channel_id == CHANNEL_ID:
             emoji = payload.emoji
-            emoji_name = str(emoji)
-            emoji_id = (
-                emoji.id
-                if isinstance(emoji, (discord.Emoji, discord.PartialEmoji))
-                else None
-            )
-            if emoji_id is not None:
-                emoji_description = emoji_name.split(":")[1]
-                filename = f"{CUSTOM_EMOJIS_FOLDER}/{emoji.id}.png"
-            else:
-                emoji_description = (
-                    str(emojilib.demojize(emoji_name, language="fr"))
-                    .replace(":", "")
-                    .replace("_", " ")
-                )
-                filename = None
             message_id = payload.message_id
+            if event_deduplicator.seen(
+                "reaction", (message_id, payload.user_id, str(emoji)), "add"
+            ):
+                return
+            emoji_name, emoji_description, filename = get_tag(emoji)
+            reaction_index.add(message_id, emoji_name)
 
-            cursor.execute(
-                "SELECT * FROM tags WHERE message_id = %s AND emoji = %s",
-                (message_id, emoji_name),
+            await journal.append(
+                storage.add_tag(message_id, emoji_name, emoji_description, filename)
             )
-            result = cursor.fetchone()
-            if result is None:
-                cursor.execute(
-                    "INSERT INTO tags (message_id, emoji, description, filename) VALUES (%s, %s, %s, %s)",
-                    (message_id, emoji_name, emoji_description, filename),
-                )
-                mydb.commit()
 
-                if (
-                    isinstance(emoji, (discord.Emoji, discord.PartialEmoji))
-                    and filename is not None
-                ):
-                    async with aiohttp.ClientSession() as session:
-                        async with session.get(str(emoji.url)) as resp:
-                            if resp.status == 200:
-                                with open(filename, "wb") as f:
-                                    f.write(await resp.read())
-        mydb.close()
+            if filename is not None:
+                await emoji_cache.fetch(emoji)
     except Exception as e:
-        print("Error in on_raw_reaction_add:", e)
+        report_error("on_raw_reaction_add", e)
 
 
 @client.event
+@metrics.handler
 async def on_raw_reaction_remove(payload: discord.RawReactionActionEvent) -> None:
     try:
         if str(payload.emoji) == str("❌"):
             return
-        mydb = mysql.connector.connect(**DB_CONFIG)
-        cursor = mydb.cursor()
 
         if payload.channel_id == CHANNEL_ID:
             emoji = payload.emoji
             emoji_name = str(emoji)
             message_id = payload.message_id
+            if event_deduplicator.seen(
+                "reaction", (message_id, payload.user_id, emoji_name), "remove"
+            ):
+                return
 
             channel = client.get_channel(payload.channel_id)
-            message = await channel.fetch_message(message_id)
-
-            for reaction in message.reactions:
-                if str(reaction.emoji) == emoji_name and reaction.count > 0:
-                    return
-
-            cursor.execute(
-                "DELETE FROM tags WHERE message_id = %s AND emoji = %s",
-                (message_id, emoji_name),
-            )
-            mydb.commit()
+            if await reaction_index.remove(channel, message_id, emoji_name) > 0:
+                return
 
-        mydb.close()
+            await journal.append(storage.remove_tag(message_id, emoji_name))
     except Exception as e:
-        print("Error in on_raw_reaction_remove:", e)
+        report_error("on_raw_reaction_remove", e)
 
 
 @client.event
+@metrics.handler
 async def on_raw_reaction_clear_emoji(
     payload: discord.RawReactionClearEmojiEvent,
 ) -> None:
     try:
         if str(payload.emoji) == str("❌"):
             return
-        mydb = mysql.connector.connect(**DB_CONFIG)
-        cursor = mydb.cursor()
 
         if payload.channel_id == CHANNEL_ID:
             emoji = payload.emoji
             emoji_name = str(emoji)
             message_id = payload.message_id
-
-            cursor.execute(
-                "DELETE FROM tags WHERE message_id = %s AND emoji = %s",
-                (message_id, emoji_name),
+            reaction_index.clear(message_id, emoji_name)
+            event_deduplicator.forget(
+                "reaction", lambda key: key[0] == message_id and key[2] == emoji_name
             )
-            mydb.commit()
 
-        mydb.close()
+            await journal.append(storage.remove_tag(message_id, emoji_name))
     except Exception as e:
-        print("Error in on_raw_reaction_clear_emoji:", e)
+        report_error("on_raw_reaction_clear_emoji", e)
 
 
 @client.event
+@metrics.handler
 async def on_raw_reaction_clear(payload: discord.RawMessageDeleteEvent) -> None:
     try:
-        mydb = mysql.connector.connect(**DB_CONFIG)
-        cursor = mydb.cursor()
         if payload.channel_id == CHANNEL_ID:
             message_id = payload.message_id
+            reaction_index.clear(message_id)
+            event_deduplicator.forget("reaction", lambda key: key[0] == message_id)
 
-            cursor.execute("DELETE FROM tags WHERE message_id = %s", (message_id,))
-            mydb.commit()
-
-        mydb.close()
+            await journal.append(storage.clear_tags(message_id))
     except Exception as e:
-        print("Error in on_raw_reaction_clear:", e)
+        report_error("on_raw_reaction_clear", e)
+
+
+@client.event
+@metrics.handler
+async def on_guild_emojis_update(
+    guild: discord.Guild,
+    before: tuple[discord.Emoji, ...],
+    after: tuple[discord.Emoji, ...],
+) -> None:
+    if guild.id == GUILD_ID:
+        await emoji_cache.refresh(before, after)
+
+
+@client.event
+@metrics.handler
+async def on_guild_role_create(role: discord.Role) -> None:
+    if role.guild.id == GUILD_ID:
+        level_roles.add(role)
+
+
+@client.event
+@metrics.handler
+async def on_guild_role_update(before: discord.Role, after: discord.Role) -> None:
+    if after.guild.id == GUILD_ID:
+        level_roles.remove(before)
+        level_roles.add(after)
+
+
+@client.event
+@metrics.handler
+async def on_guild_role_delete(role: discord.Role) -> None:
+    if role.guild.id == GUILD_ID:
+        level_roles.remove(role)
 
 
 @client.event
+@metrics.handler
 async def on_user_update(before: discord.User, after: discord.User) -> None:
     try:
-        mydb = mysql.connector.connect(**DB_CONFIG)
-        cursor = mydb.cursor()
-        await update_user_profile(cursor, after)
-        mydb.commit()
-        mydb.close()
+        await journal.append(await update_user_profile(after))
     except Exception as e:
-        print("Error in on_user_update:", e)
+        report_error("on_user_update", e)
 
 
 @client.event
+@metrics.handler
 async def on_member_update(before: discord.Member, after: discord.Member) -> None:
     try:
-        mydb = mysql.connector.connect(**DB_CONFIG)
-        cursor = mydb.cursor()
-        await update_user_profile(cursor, after)
-        mydb.commit()
-        mydb.close()
+        await journal.append(await update_user_profile(after))
     except Exception as e:
-        print("Error in on_member_update:", e)
+        report_error("on_member_update", e)
+
+
+async def expire_streak_roles(
+    guild: discord.Guild, user_ids: list[int]
+) -> tuple[int, int, int]:
+    semaphore = asyncio.Semaphore(ROLE_UPDATE_CONCURRENCY)
+    members = [guild.get_member(user_id) for user_id in user_ids]
+    expired = {
+        member: [
+            role for role in member.roles if role.name.startswith("electrogram niveau")
+        ]
+        for member in members
+        if member is not None
+    }
+    expired = {member: roles for member, roles in expired.items() if roles}
+
+    async def expire(member: discord.Member, roles: list[discord.Role]) -> None:
+        async with semaphore:
+            await outbound.call(member.remove_roles(*roles))
+
+    results = await asyncio.gather(
+        *(expire(member, roles) for member, roles in expired.items()),
+        return_exceptions=True,
+    )
+    failed = 0
+    removed = set()
+    for (member, roles), result in zip(expired.items(), results):
+        if isinstance(result, Exception):
+            print("Error in expire_streak_roles:", member.id, result)
+            failed += 1
+        else:
+            removed.add(member.id)
+
+    deleted = 0
+    for role in {role for roles in expired.values() for role in roles}:
+        if all(member.id in removed for member in role.members):
+            try:
+                await outbound.call(role.delete())
+                deleted += 1
+            except discord.HTTPException as e:
+                print("Error in expire_streak_roles:", role.name, e)
+    return len(removed), failed, deleted
 
 
 @tasks.loop(time=time)
+@metrics.handler
 async def streak_update() -> None:
+    global streak_expiry_cutoff
     try:
+        started = monotonic()
         guild = client.get_guild(GUILD_ID)
-        for member in guild.members:
-            mydb = mysql.connector.connect(**DB_CONFIG)
-            cursor = mydb.cursor()
-            cursor.execute(
-                "SELECT last_message_date FROM streaks WHERE user_id = %s", (member.id,)
-            )
-            result = cursor.fetchone()
-            if result is not None:
-                last_message_date = result[0]
-                mydb.commit()
-                mydb.close()
-                today = datetime.date.today()
-                days_difference = (today - last_message_date).days
-                await update_user_roles(member, days_difference, None, True)
-            else:
-                mydb.commit()
-                mydb.close()
+        cutoff = datetime.date.today() - datetime.timedelta(days=2)
+        previous_cutoff = streak_expiry_cutoff or datetime.date.min
+        async with db.connection() as conn:
+            user_ids = await storage.get_expired_streaks(conn, previous_cutoff, cutoff)
+        updated, failed, deleted = await expire_streak_roles(guild, user_ids)
+        if failed == 0:
+            streak_expiry_cutoff = cutoff
+        print(
+            f"Nightly streak expiry: {len(user_ids)} streaks expired,",
+            f"roles removed from {updated} members ({failed} failed),",
+            f"{deleted} empty roles deleted in {monotonic() - started:.2f}s",
+        )
     except Exception as e:
-        print("Error in streak_update:", e)
+        report_error("streak_update", e)
 
 
-client.run(BOT_TOKEN)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "command",
+        nargs="?",
+        choices=["run", "backfill", "compact", "verify", "rebuild-stats"],
+        default="run",
+    )
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="backfill the whole channel history and drop messages deleted meanwhile",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="only report what compact would change",
+    )
+    options = parser.parse_args()
+    startup.mark("imports")
+    if options.command == "compact":
+        exit(asyncio.run(compact_attachments(options.dry_run)))
+    elif options.command == "verify":
+        exit(asyncio.run(verify_attachments()))
+    elif options.command == "rebuild-stats":
+        exit(asyncio.run(rebuild_user_stats()))
+    client.run(BOT_TOKEN)